@@ -0,0 +1,177 @@
+'''
+Benchmark of the processing chain on synthetic
+LVIS files, timing each stage and writing the
+results to a JSON file
+'''
+
+import numpy as np
+import h5py
+import argparse
+import copy
+import json
+import os
+import platform
+import tempfile
+import time
+import lvisKernels
+from stageLog import peakRSS
+from flightClass import flightLine
+from rasterClass import handleTiff, changeDetection
+from task4 import ContourRast
+
+def readCommands():
+  '''
+  Read commandline arguments
+  '''
+  p = argparse.ArgumentParser(description=("Benchmark the LVIS processing chain on synthetic data"))
+  p.add_argument("--nWaves", dest ="nWaves", type=int, default=100000, help=("Number of footprints in the synthetic file"))
+  p.add_argument("--nBins", dest ="nBins", type=int, default=500, help=("Number of bins per waveform"))
+  p.add_argument("--noise", dest ="noise", type=float, default=20.0, help=("Mean background noise of the waveforms (counts)"))
+  p.add_argument("--cloud", dest ="cloud", type=float, default=0.05, help=("Fraction of waveforms with no ground return"))
+  p.add_argument("--seed", dest ="seed", type=int, default=0, help=("Random seed"))
+  p.add_argument("--outres", dest ="outRes", type=int, default=50, help=("Output resolution (m)"))
+  p.add_argument("--window", dest ="window", type=int, default=5, help=("Search window of the gap filling focal function (pixels)"))
+  p.add_argument("--interval", dest ="interval", type=float, default=1.0, help=("Contour interval of the change raster (m)"))
+  p.add_argument("--backend", dest ="backend", type=str, default=lvisKernels.backend, choices=["numba","numpy"], help=("Kernel backend for the waveform stages"))
+  p.add_argument("--workdir", dest ="workDir", type=str, default=None, help=("Directory for the synthetic files (a temporary one by default)"))
+  p.add_argument("--output", dest ="outName", type=str, default='benchmark.json', help=("Results filename"))
+  cmdargs = p.parse_args()
+  return cmdargs
+
+
+def makeLVIS(filename,nWaves=100000,nBins=500,noise=20.0,cloud=0.05,seed=0,bounds=(260.0,-82.5,260.5,-82.3),binSize=0.3,blockSize=10000):
+  '''
+  Write a synthetic LVIS L1B file in the layout of the
+  real ones: footprints spread over bounds, each a
+  Poisson background with a Gaussian ground return
+  from a smoothly varying surface, bar a fraction
+  cloud of them with none. Written blockSize
+  footprints at a time to bound memory
+  '''
+  r=np.random.default_rng(seed)
+  x0,y0,x1,y1=bounds
+  f=h5py.File(filename,'w')
+  rxwave=f.create_dataset('RXWAVE',(nWaves,nBins),dtype=np.uint16)
+  cols={}
+  for name in ('LON0','LAT0','LON'+str(nBins-1),'LAT'+str(nBins-1),'Z0','Z'+str(nBins-1)):
+    cols[name]=f.create_dataset(name,(nWaves,),dtype=np.float64)
+  f['LFID']=np.full(nWaves,1000000,dtype=np.int64)
+  f['SHOTNUMBER']=np.arange(nWaves,dtype=np.int64)
+
+  bins=np.arange(nBins)
+  for start in range(0,nWaves,blockSize):
+    n=min(blockSize,nWaves-start)
+    end=start+n
+    lon=x0+(x1-x0)*r.random(n)
+    lat=y0+(y1-y0)*r.random(n)
+    # gently rolling ground, with a bit of roughness
+    u=(lon-x0)/(x1-x0)
+    v=(lat-y0)/(y1-y0)
+    ground=1500.0+20.0*np.sin(2.0*np.pi*u)*np.cos(np.pi*v)+r.normal(0.0,0.2,n)
+
+    # top of the wave somewhere above the ground
+    lZ0=ground+r.uniform(0.2,0.6,n)*nBins*binSize
+    groundBin=(lZ0-ground)/binSize
+    amp=r.uniform(100.0,400.0,n)*(r.random(n)>=cloud)
+    waves=r.poisson(noise,(n,nBins))+amp[:,np.newaxis]*np.exp(-0.5*((bins-groundBin[:,np.newaxis])/2.0)**2)
+    rxwave[start:end]=np.clip(np.round(waves),0,65535).astype(np.uint16)
+
+    cols['LON0'][start:end]=lon
+    cols['LAT0'][start:end]=lat
+    cols['LON'+str(nBins-1)][start:end]=lon+1e-6
+    cols['LAT'+str(nBins-1)][start:end]=lat+1e-6
+    cols['Z0'][start:end]=lZ0
+    cols['Z'+str(nBins-1)][start:end]=lZ0-nBins*binSize
+  f.close()
+
+
+def timeStage(results,name,items,func,*args,**kwargs):
+  '''
+  Run one stage, adding its time, throughput and
+  the peak memory so far to the list results
+  '''
+  start=time.perf_counter()
+  out=func(*args,**kwargs)
+  seconds=time.perf_counter()-start
+  rate=items/seconds if seconds>0 else None
+  results.append({'stage':name,'seconds':seconds,'items':int(items),'perSecond':rate,'peakRSS':peakRSS()})
+  print("%-16s %9.3f s %14.0f items/s %8.0f MB"%(name,seconds,rate or 0,peakRSS()/2**20))
+  return(out)
+
+
+def runBenchmark(filename,workDir,res=50,window=5,interval=1.0):
+  '''
+  Time each stage of the chain on one file,
+  returning a list of results per stage
+  '''
+  results=[]
+  with h5py.File(filename,'r') as f:
+    nWaves=f['RXWAVE'].shape[0]
+
+  # compile any kernels on a few footprints first, so they are not timed
+  warm=flightLine(filename=filename,rows=np.arange(min(100,nWaves)))
+  warm.setElevations(implicit=True)
+  warm.estimateGround()
+  warm.CofG()
+
+  lvis=timeStage(results,'readLVIS',nWaves,flightLine,filename=filename)
+  timeStage(results,'setElevations',nWaves,lvis.setElevations,implicit=True)
+  timeStage(results,'estimateGround',nWaves,lvis.estimateGround)
+  timeStage(results,'CofG',nWaves,lvis.CofG)
+  timeStage(results,'reproject',nWaves,lvis.reproject,inEPSG=4326,outEPSG=3031)
+  tifName=os.path.join(workDir,'bench_ground.tif')
+  timeStage(results,'writeSingleTiff',nWaves,lvis.writeSingleTiff,res=res,filename=tifName)
+  del lvis
+
+  # gap fill the gridded ground
+  dem=handleTiff(filename=tifName,readTiff=True)
+  nPixels=dem.data.size
+  timeStage(results,'getSurround',nPixels,dem.getSurround,window=window)
+
+  # a second DEM with a bump and a tilt of change
+  before=copy.copy(dem)
+  before.data=dem.fill
+  after=copy.copy(before)
+  y,x=np.mgrid[0:dem.nY,0:dem.nX]
+  after.data=(before.data+5.0*np.exp(-((x-dem.nX/2.0)**2+(y-dem.nY/2.0)**2)/(2.0*(dem.nX/6.0)**2))+2.0*x/dem.nX).astype(before.data.dtype)
+  change=changeDetection.__new__(changeDetection)
+  change.arrayCalc(before,after)
+  timeStage(results,'volumnCalc',nPixels,change.volumnCalc,before,after)
+
+  # contour the change
+  contours=ContourRast.__new__(ContourRast)
+  contours.arrayCalc(before,after)
+  contours.volumnCalc(before,after)
+  timeStage(results,'ContourRast',nPixels,contours.roundCont,interval=interval)
+  return(results)
+
+
+if __name__=="__main__":
+    cmd = readCommands()
+    lvisKernels.setBackend(cmd.backend)
+
+    workDir = cmd.workDir if cmd.workDir is not None else tempfile.mkdtemp(prefix='lvisBench')
+    os.makedirs(workDir,exist_ok=True)
+    h5Name = os.path.join(workDir,'bench_%d_%d.h5'%(cmd.nWaves,cmd.nBins))
+
+    start_time = time.perf_counter()
+    makeLVIS(h5Name,nWaves=cmd.nWaves,nBins=cmd.nBins,noise=cmd.noise,cloud=cmd.cloud,seed=cmd.seed)
+    genTime = time.perf_counter()-start_time
+    print("Synthetic file of %d footprints written in %.1f seconds"%(cmd.nWaves,genTime))
+
+    stages = runBenchmark(h5Name,workDir,res=cmd.outRes,window=cmd.window,interval=cmd.interval)
+
+    report = {'config': {'nWaves':cmd.nWaves,'nBins':cmd.nBins,'noise':cmd.noise,'cloud':cmd.cloud,
+                         'seed':cmd.seed,'outRes':cmd.outRes,'window':cmd.window,'interval':cmd.interval,
+                         'backend':cmd.backend},
+              'system': {'python':platform.python_version(),'numpy':np.__version__,
+                         'machine':platform.machine(),'node':platform.node(),
+                         'time':time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'generateSeconds': genTime,
+              'fileBytes': os.path.getsize(h5Name),
+              'stages': stages,
+              'totalSeconds': sum([s['seconds'] for s in stages]),
+              'peakRSS': peakRSS()}
+    with open(cmd.outName,'w') as f:
+        json.dump(report,f,indent=2)
+    print("Results written to",cmd.outName)
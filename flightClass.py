@@ -0,0 +1,327 @@
+'''
+The flightLine class of Task 1, which finds the
+ground of LVIS footprints and grids it, kept
+out of the script so it can be imported alone
+'''
+
+###################################
+import numpy as np
+from processLVIS import lvisGround, REASON_OK, REASON_NOGROUND
+from lvisClass import selectBounds
+import lvisKernels
+import stageLog
+
+###################################
+
+class flightLine(lvisGround):
+
+  @stageLog.timed('CofG',items='nWaves')
+  def CofG(self,alternatives=False):
+    '''
+    Find centre of gravity of denoised waveforms
+    sets this to an array of ground elevation
+    estimates, zG, NaN for empty waveforms and
+    those screened out by estimateGround.
+    alternatives=True also sets zMode, the lowest
+    peak, and zLast, the lowest bin above threshold
+    before smoothing, from denoise's lastBin
+    '''
+    lZ0,zStep=self.lZ0,self.zStep
+    z=None if(self.implicitZ) else self.z
+
+    if(self.store is not None):
+      zG,zMode=self.storeCofG(lZ0,zStep,alternatives)
+    elif((z is None) and lvisKernels.useKernels()):
+      # both from one compiled pass over each wave
+      meanBin,modeBin=lvisKernels.centreOfGravity(self.denoised)
+      zG=lZ0+zStep*meanBin
+      zMode=binElevation(modeBin,modeBin>=0,lZ0,zStep)
+    else:
+      zG,zMode=self.denseCofG(lZ0,zStep,z,alternatives)
+
+    self.zG=zG
+    if(alternatives):
+      self.zLast=binElevation(self.lastBin,self.lastBin>=0,lZ0,zStep,z)
+      self.zMode=zMode
+
+    # note waves that passed screening but had no ground
+    if(getattr(self,'reason',None) is not None):
+      self.reason[np.isnan(zG)&(self.reason==REASON_OK)]=REASON_NOGROUND
+
+  def denseCofG(self,lZ0,zStep,z=None,alternatives=False):
+    '''
+    CofG of every wave of a full denoised array
+    at once, with the lowest peak if alternatives
+    '''
+    # empty waveforms (clouds etc) have no weight
+    nRows=self.denoised.shape[0]
+    total=np.sum(self.denoised,axis=1)
+    valid=total>0.0
+
+    # weighted mean elevation of every wave at once
+    with np.errstate(invalid='ignore',divide='ignore'):
+      if(z is None):
+        meanBin=(self.denoised@np.arange(self.nBins,dtype=np.float64))/total
+        zG=lZ0+zStep*meanBin
+      else:
+        zG=np.einsum('ij,ij->i',z,self.denoised)/total
+    zG[~valid]=np.nan
+    if(not alternatives):
+      return(zG,None)
+
+    # local maxima of the smoothed wave, flat tops taking the lowest bin
+    wave=self.denoised
+    above=np.concatenate((np.zeros((nRows,1)),wave[:,:-1]),axis=1)
+    below=np.concatenate((wave[:,1:],np.zeros((nRows,1))),axis=1)
+    peak=(wave>0.0)&(wave>=above)&(wave>below)
+
+    # bins run down from the top, so the lowest peak is the last
+    modeBin=self.nBins-1-np.argmax(peak[:,::-1],axis=1)
+    zMode=binElevation(modeBin,valid&np.any(peak,axis=1),lZ0,zStep,z)
+    return(zG,zMode)
+
+  def storeCofG(self,lZ0,zStep,alternatives=False):
+    '''
+    CofG of waves denoised in a waveStore,
+    summing each wave's window with bincount
+    '''
+    store=self.store
+    wave=store.waveIndex()
+    bins=store.binIndex()
+    total=np.bincount(wave,weights=self.denoised,minlength=store.nWaves)
+    valid=total>0.0
+    with np.errstate(invalid='ignore',divide='ignore'):
+      meanBin=np.bincount(wave,weights=self.denoised*bins,minlength=store.nWaves)/total
+    zG=lZ0+zStep*meanBin
+    zG[~valid]=np.nan
+    if(not alternatives):
+      return(zG,None)
+
+    # neighbours within the same window, zero past its ends
+    starts=store.offsets[:-1][np.diff(store.offsets)>0]
+    ends=store.offsets[1:][np.diff(store.offsets)>0]-1
+    above=np.concatenate(([0.0],self.denoised[:-1]))
+    above[starts]=0.0
+    below=np.concatenate((self.denoised[1:],[0.0]))
+    below[ends]=0.0
+    peak=(self.denoised>0.0)&(self.denoised>=above)&(self.denoised>below)
+
+    # the last peak of each wave is its lowest
+    modeBin=np.full(store.nWaves,-1)
+    ind=np.flatnonzero(peak)
+    modeBin[wave[ind]]=bins[ind]    # later values overwrite earlier ones
+    return(zG,binElevation(modeBin,modeBin>=0,lZ0,zStep))
+
+  @classmethod
+  def streamGround(cls,filename,chunkSize=100000,inEPSG=4326,outEPSG=3031,compact=False,saturation=None,**kwargs):
+    '''
+    Push blocks of chunkSize footprints through the
+    elevation, ground, CofG and reprojection stages.
+    Each block is yielded with its waveform arrays
+    dropped, leaving the coordinates, zG and reason.
+    compact=True crops the waves to their signal
+    '''
+    for lvis in cls.readChunks(filename,chunkSize=chunkSize,inEPSG=inEPSG,**kwargs):
+      if lvis.checkpoint == 1:
+        lvis.setElevations(implicit=True)
+        lvis.estimateGround(compact=compact,saturation=saturation)
+        lvis.CofG()
+        lvis.reproject(inEPSG=inEPSG,outEPSG=outEPSG)
+        del lvis.waves, lvis.denoised, lvis.store    # free the waveforms
+        yield lvis
+
+  @classmethod
+  def fromStream(cls,filename,chunkSize=100000,inEPSG=4326,outEPSG=3031,compact=False,saturation=None,**kwargs):
+    '''
+    Gather the ground elevations and coordinates
+    of every block from streamGround in to one
+    object, ready for writeSingleTiff
+    '''
+    lon=[]
+    lat=[]
+    zG=[]
+    reason=[]
+    for chunk in cls.streamGround(filename,chunkSize=chunkSize,inEPSG=inEPSG,outEPSG=outEPSG,compact=compact,saturation=saturation,**kwargs):
+      lon.append(chunk.lon)
+      lat.append(chunk.lat)
+      zG.append(chunk.zG)
+      reason.append(chunk.reason)
+
+    lvis=cls.__new__(cls)
+    lvis.nWaves=sum([len(z) for z in zG])
+    lvis.checkpoint=int(lvis.nWaves>0)
+    if lvis.checkpoint == 1:
+      lvis.lon=np.concatenate(lon)
+      lvis.lat=np.concatenate(lat)
+      lvis.zG=np.concatenate(zG)
+      lvis.reason=np.concatenate(reason)
+    return lvis
+
+  @classmethod
+  def fromCache(cls,filename,cache,chunkSize=0,inEPSG=4326,outEPSG=3031,minX=-1000000,maxX=10000000,minY=-10000000,maxY=10000000,rows=None,bboxEPSG=None,compact=False,**groundArgs):
+    '''
+    Ground elevations of the footprints within bounds,
+    taken from a groundCache. On a miss the whole file
+    goes through the elevation, ground and CofG stages
+    and is cached, so other bounds can use it later.
+    groundArgs are passed to estimateGround
+    '''
+    params=dict(sigThresh=5,statsLen=10,minWidth=3,sWidth=0.5,runFilter=False,robust=False,saturation=None)
+    params.update(groundArgs)
+    columns=cache.load(filename,params)
+    if columns is None:
+      if chunkSize > 0:
+        chunks=cls.readChunks(filename,chunkSize=chunkSize)
+      else:
+        chunks=[cls(filename)]
+      names=('lon','lat','zG','reason','lShot','lfid')
+      parts=dict([(n,[]) for n in names])
+      for lvis in chunks:
+        if lvis.checkpoint == 1:
+          lvis.setElevations(implicit=True)
+          lvis.estimateGround(compact=compact,**params)
+          lvis.CofG()
+          for n in names:
+            parts[n].append(getattr(lvis,n))
+          del lvis.waves, lvis.denoised, lvis.store    # free the waveforms
+      columns=dict([(n,np.concatenate(parts[n])) for n in names if len(parts[n]) > 0])
+      if len(columns) > 0:
+        cache.save(filename,params,columns)
+
+    # the cached columns are in file row order
+    lvis=cls.__new__(cls)
+    lvis.checkpoint=0
+    if len(columns) > 0:
+      useInd=np.arange(columns['zG'].shape[0]) if rows is None else rows
+      useInd=useInd[selectBounds(columns['lon'][useInd],columns['lat'][useInd],minX,minY,maxX,maxY,bboxEPSG,inEPSG)]
+      lvis.nWaves=useInd.shape[0]
+      lvis.checkpoint=int(lvis.nWaves>0)
+    if lvis.checkpoint == 1:
+      for n in columns:
+        setattr(lvis,n,columns[n][useInd])
+      lvis.reproject(inEPSG=inEPSG,outEPSG=outEPSG)
+    return lvis
+
+  def gridGround(self,res,stat='mean'):
+      '''
+      Bin the ground elevations in to cells of res,
+      reducing each cell to one statistic. Returns
+      the flat indices of the non-empty cells of the
+      nY by nX grid from (minX,maxY) and their values
+      '''
+
+      # determine bounds
+      self.minX=np.min(self.lon)
+      maxX=np.max(self.lon)
+      minY=np.min(self.lat)
+      self.maxY=np.max(self.lat)
+
+      # determine image size
+      self.nX=int((maxX-self.minX)/res+1)
+      self.nY=int((self.maxY-minY)/res+1)
+
+      xInds=np.array((self.lon-self.minX)/res,dtype=int)  # determine which pixels the data lies in
+      yInds=np.array((self.maxY-self.lat)/res,dtype=int)  # determine which pixels the data lies in
+
+      # every footprint with a ground estimate counts towards its pixel
+      use=np.isfinite(self.zG)
+      return(binStats(yInds[use]*self.nX+xInds[use],self.zG[use],stat=stat))
+
+  @stageLog.timed('write',items='nWaves')
+  def writeSingleTiff(self,res,filename,stat='mean',blockSize=256):
+      '''
+      Make a geotiff from an array of points, taking the
+      stat of all footprints in each pixel. Only blocks
+      holding data are written, to a sparse tiled geotiff
+      '''
+      from osgeo import gdal, osr
+      cells,values=self.gridGround(res,stat=stat)
+
+      # set geolocation information (note geotiffs count down from top edge in Y)
+      geotransform = (self.minX, res, 0, self.maxY, 0, -res)
+
+      # load data in to geotiff object
+      options=['TILED=YES','BLOCKXSIZE='+str(blockSize),'BLOCKYSIZE='+str(blockSize),'SPARSE_OK=TRUE','BIGTIFF=IF_SAFER']
+      dst_ds = gdal.GetDriverByName('GTiff').Create(filename,self.nX,self.nY, 1, gdal.GDT_Float32, options=options)
+
+      dst_ds.SetGeoTransform(geotransform)    # specify coords
+      srs = osr.SpatialReference()            # establish encoding
+      srs.ImportFromEPSG(3031)                # WGS84 lat/long
+      dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
+      dst_ds.GetRasterBand(1).SetNoDataValue(np.nan)  # set no data value
+      writeBlocks(dst_ds.GetRasterBand(1),cells,values,self.nX,self.nY,blockSize)  # write image to the raster
+      dst_ds.FlushCache()                     # write to disk
+      dst_ds = None
+
+      print("Image written to",filename)
+      return
+
+
+def binStats(cells,values,stat='mean'):
+  '''
+  Reduce the values falling in each cell to one
+  statistic: mean, median, min, max, count or std.
+  Returns the sorted non-empty cells and their values
+  '''
+  if(cells.shape[0]==0):
+    return(cells,values.astype(float))
+
+  if(stat in ('mean','count','std')):
+    occupied,inverse=np.unique(cells,return_inverse=True)
+    count=np.bincount(inverse)
+    if(stat=='count'):
+      return(occupied,count.astype(float))
+    mean=np.bincount(inverse,weights=values)/count
+    if(stat=='mean'):
+      return(occupied,mean)
+    return(occupied,np.sqrt(np.bincount(inverse,weights=(values-mean[inverse])**2)/count))
+
+  # order statistics, from one sort by cell then value
+  order=np.lexsort((values,cells))
+  cells=cells[order]
+  values=values[order]
+  start=np.flatnonzero(np.concatenate(([True],cells[1:]!=cells[:-1])))
+  end=np.append(start[1:],cells.shape[0])
+  if(stat=='min'):
+    return(cells[start],values[start])
+  elif(stat=='max'):
+    return(cells[start],values[end-1])
+  elif(stat=='median'):
+    return(cells[start],(values[(start+end-1)//2]+values[(start+end)//2])/2.0)
+  raise ValueError("Unknown statistic "+str(stat))
+
+
+def binElevation(bins,valid,lZ0,zStep,z=None):
+  '''
+  Elevation of one bin of each wave, from its
+  top and bin spacing or its array of bin
+  elevations, NaN where valid is False
+  '''
+  if(z is None):
+    elev=lZ0+zStep*bins
+  else:
+    elev=z[np.arange(z.shape[0]),bins]
+  return(np.where(valid,elev,np.nan))
+
+
+def writeBlocks(band,cells,values,nX,nY,blockSize):
+  '''
+  Write values of flat cell indices to a raster band
+  one block at a time, skipping blocks with no data,
+  which a SPARSE_OK geotiff leaves unallocated
+  '''
+  rows=cells//nX
+  cols=cells%nX
+  nBlockX=(nX+blockSize-1)//blockSize
+  block=(rows//blockSize)*nBlockX+cols//blockSize
+
+  order=np.argsort(block,kind='stable')
+  breaks=np.flatnonzero(np.diff(block[order]))+1
+  for group in np.split(order,breaks):
+    if(group.shape[0]==0):
+      continue
+    y0=(block[group[0]]//nBlockX)*blockSize
+    x0=(block[group[0]]%nBlockX)*blockSize
+    tile=np.full((min(blockSize,nY-y0),min(blockSize,nX-x0)),np.nan,dtype=np.float32)
+    tile[rows[group]-y0,cols[group]-x0]=values[group]
+    band.WriteArray(tile,int(x0),int(y0))
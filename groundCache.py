@@ -0,0 +1,106 @@
+'''
+An on-disk cache of the ground elevations
+found in each LVIS file, so they can be
+gridded again without the waveforms
+'''
+
+###################################
+import os
+import json
+import hashlib
+import numpy as np
+
+###################################
+
+class groundCache(object):
+  '''
+  Directory of one columnar .npz file per LVIS file,
+  holding lon, lat, zG, shot number and flight ID of
+  every footprint in file order. Entries are keyed on
+  the file's path, mtime and size and the parameters
+  of estimateGround, and the least recently used are
+  removed once the cache passes maxBytes
+  '''
+
+  def __init__(self,cacheDir,maxBytes=2**30):
+    '''
+    Class initialiser. maxBytes is the
+    size the cache is kept under
+    '''
+    self.cacheDir=cacheDir
+    self.maxBytes=maxBytes
+    os.makedirs(cacheDir,exist_ok=True)
+
+
+  ###########################################
+
+  def entryName(self,filename,params):
+    '''
+    Cache file for an LVIS file processed
+    with the estimateGround parameters
+    '''
+    filename=os.path.abspath(filename)
+    stat=os.stat(filename)
+    key=json.dumps([filename,stat.st_mtime_ns,stat.st_size,sorted(params.items())])
+    digest=hashlib.sha1(key.encode()).hexdigest()[:16]
+    return(os.path.join(self.cacheDir,os.path.basename(filename)[:-3]+'_'+digest+'.npz'))
+
+
+  ###########################################
+
+  def load(self,filename,params):
+    '''
+    Return a dictionary of the cached columns,
+    or None if there are none
+    '''
+    name=self.entryName(filename,params)
+    try:
+      with np.load(name) as f:
+        columns={k:f[k] for k in f.files}
+    except (FileNotFoundError,OSError,ValueError):   # missing, evicted or half written
+      return(None)
+    # mark as recently used
+    os.utime(name)
+    return(columns)
+
+
+  ###########################################
+
+  def save(self,filename,params,columns):
+    '''
+    Write the columns of an LVIS file to the
+    cache in a single step, then evict
+    '''
+    name=self.entryName(filename,params)
+    tmpName=name[:-4]+'.'+str(os.getpid())+'.tmp'
+    with open(tmpName,'wb') as f:
+      np.savez(f,**columns)
+    os.replace(tmpName,name)
+    self.evict()
+
+
+  ###########################################
+
+  def evict(self):
+    '''
+    Remove the least recently used entries
+    until the cache is under maxBytes
+    '''
+    entries=[]
+    for name in os.listdir(self.cacheDir):
+      if(name.endswith('.npz')):
+        try:
+          stat=os.stat(os.path.join(self.cacheDir,name))
+        except FileNotFoundError:   # removed by another process
+          continue
+        entries.append((stat.st_mtime,stat.st_size,name))
+
+    total=sum([e[1] for e in entries])
+    for mtime,size,name in sorted(entries):
+      if(total<=self.maxBytes):
+        break
+      try:
+        os.remove(os.path.join(self.cacheDir,name))
+      except FileNotFoundError:
+        pass
+      total-=size
@@ -7,7 +7,7 @@ with methods to read
 ###################################
 import numpy as np
 import h5py
-from pyproj import Proj, transform
+import stageLog
 
 ###################################
 
@@ -16,7 +16,7 @@ class lvisData(object):
   LVIS data handler
   '''
 
-  def __init__(self,filename,setElev=False,minX=-1000000,maxX=10000000,minY=-10000000,maxY=10000000,onlyBounds=False):
+  def __init__(self,filename,setElev=False,minX=-1000000,maxX=10000000,minY=-10000000,maxY=10000000,onlyBounds=False,rows=None,index=None,bboxEPSG=None,inEPSG=4326):
     '''
     Class initialiser. Calls a function
     to read LVIS data within bounds
@@ -24,9 +24,20 @@ class lvisData(object):
     setElev=1 converts LVIS's stop and start
     elevations to arrays of elevation.
     onlyBounds sets "bounds" to the corner of the area of interest
+    rows limits reading to those footprint numbers of the file
+    index is an lvisIndex used to find those rows within bounds
+    bboxEPSG gives the bounds in another projection to the
+    file's lon/lat, which is inEPSG
     '''
+    # look up which rows can be in bounds
+    if((index is not None) and (rows is None) and (not onlyBounds)):
+      rows=index.fileRows(filename,minX,minY,maxX,maxY,bboxEPSG=bboxEPSG,inEPSG=inEPSG)
+
+    # waveforms are held whole until compacted
+    self.store=None
+
     # call the file reader and load in to the self
-    self.readLVIS(filename,minX,minY,maxX,maxY,onlyBounds)
+    self.readLVIS(filename,minX,minY,maxX,maxY,onlyBounds,inEPSG=inEPSG,rows=rows,bboxEPSG=bboxEPSG)
 
     if(setElev):     # to save time, only read elev if wanted
       self.setElevations()
@@ -34,73 +45,121 @@ class lvisData(object):
 
   ###########################################
 
-  def readLVIS(self,filename,minX,minY,maxX,maxY,onlyBounds,inEPSG=4326,outEPSG=3031):
+  @classmethod
+  def readChunks(cls,filename,chunkSize=100000,rows=None,index=None,**kwargs):
+    '''
+    Read a file in blocks of chunkSize footprints,
+    yielding one object per block. Memory is then
+    bounded by the chunk size, not the file size
+    rows or an lvisIndex limit the footprints read
+    '''
+    if((index is not None) and (rows is None)):
+      rows=index.fileRows(filename,kwargs.get('minX',-1000000),kwargs.get('minY',-10000000),kwargs.get('maxX',10000000),kwargs.get('maxY',10000000),bboxEPSG=kwargs.get('bboxEPSG'),inEPSG=kwargs.get('inEPSG',4326))
+    if(rows is None):
+      f=h5py.File(filename,'r')
+      rows=np.arange(0,f['LON0'].shape[0])
+      f.close()
+    for start in range(0,rows.shape[0],chunkSize):
+      yield cls(filename,rows=rows[start:start+chunkSize],**kwargs)
+      stageLog.progress('footprints',min(start+chunkSize,rows.shape[0]),rows.shape[0])
+
+
+  ###########################################
+
+  @stageLog.timed('readLVIS',items='nWaves',nBytes=('waves','lon','lat','lZ0','lZN','lfid','lShot'))
+  def readLVIS(self,filename,minX,minY,maxX,maxY,onlyBounds,inEPSG=4326,outEPSG=3031,rows=None,bboxEPSG=None):
     '''
     Read LVIS data from file
+    Only footprints within bounds are read,
+    one hyperslab per contiguous run of them.
+    Bounds in bboxEPSG are first turned in to a
+    wider lon/lat box, and only the footprints in
+    that are reprojected for the exact test
     '''
 
+    # nothing to read if no rows were asked for
+    if((rows is not None) and (not onlyBounds)):
+      if(rows.shape[0]==0):
+        print("No data contained in that region")
+        self.checkpoint = 0
+        return
+
     # open file for reading
     f=h5py.File(filename,'r')
     # determine how many bins
     self.nBins=f['RXWAVE'].shape[1]
     # read coordinates for subsetting
-    lon0=np.array(f['LON0'])       # longitude of waveform top
-    lat0=np.array(f['LAT0'])       # lattitude of waveform top
-    lonN=np.array(f['LON'+str(self.nBins-1)]) # longitude of waveform bottom
-    latN=np.array(f['LAT'+str(self.nBins-1)]) # lattitude of waveform bottom
-    # find a single coordinate per footprint
-    tempLon=(lon0+lonN)/2.0
-    tempLat=(lat0+latN)/2.0
+    tempLon,tempLat=readCoords(f,rows)
 
     # write out bounds and leave if needed
     if(onlyBounds):
       self.lon=tempLon
       self.lat=tempLat
       self.bounds=self.dumpBounds()
+      f.close()
       return
 
     # dertermine which are in region of interest
-    useInd=np.where((tempLon>=minX)&(tempLon<maxX)&(tempLat>=minY)&(tempLat<maxY))
-    if(len(useInd)>0):
-        useInd=useInd[0]
-        self.checkpoint = 1
+    useInd=selectBounds(tempLon,tempLat,minX,minY,maxX,maxY,bboxEPSG,inEPSG)
+    if(useInd.shape[0]==0):
+      print("No data contained in that region")
+      self.checkpoint = 0
+      f.close()
+      return
+    self.checkpoint = 1
 
-    if(len(useInd)==0):
-        print("No data contained in that region")
-        self.checkpoint = 0
+    # save the subset of all data
+    self.nWaves=len(useInd)
+    self.lon=tempLon[useInd]
+    self.lat=tempLat[useInd]
 
-    if self.checkpoint == 1:
-        # save the subset of all data
-        self.nWaves=len(useInd)
-        self.lon=tempLon[useInd]
-        self.lat=tempLat[useInd]
-
-        # load sliced arrays, to save RAM
-        self.lfid=np.array(f['LFID'])[useInd]          # LVIS flight ID number
-        self.lShot=np.array(f['SHOTNUMBER'])[useInd]   # the LVIS shot number, a label
-        self.waves=np.array(f['RXWAVE'])[useInd]       # the recieved waveforms. The data
-        self.nBins=self.waves.shape[1]
-        # these variables will be converted to easier variables
-        self.lZN=np.array(f['Z'+str(self.nBins-1)])[useInd]       # The elevation of the waveform bottom
-        self.lZ0=np.array(f['Z0'])[useInd]          # The elevation of the waveform top
-        # close file
-        f.close()
-        # return to initialiser
+    # file rows of the footprints wanted
+    if(rows is not None):
+      useInd=rows[useInd]
+
+    # load only those rows, to save RAM
+    self.lfid=readRows(f['LFID'],useInd)          # LVIS flight ID number
+    self.lShot=readRows(f['SHOTNUMBER'],useInd)   # the LVIS shot number, a label
+    self.waves=readRows(f['RXWAVE'],useInd)       # the recieved waveforms. The data
+    self.nBins=self.waves.shape[1]
+    # these variables will be converted to easier variables
+    self.lZN=readRows(f['Z'+str(self.nBins-1)],useInd)       # The elevation of the waveform bottom
+    self.lZ0=readRows(f['Z0'],useInd)          # The elevation of the waveform top
+    # close file
+    f.close()
+    # return to initialiser
     return
 
 
   ###########################################
 
-  def setElevations(self):
+  @stageLog.timed('setElevations',items='nWaves')
+  def setElevations(self,implicit=False):
     '''
     Decodes LVIS's RAM efficient elevation
     format and produces an array of
     elevations per waveform bin
+    implicit=True only keeps the bin spacing,
+    zStep, leaving z to be worked out from
+    lZ0 and the bin number when needed
+    '''
+    # elevation change per bin, spaced as np.arange would
+    res=(self.lZ0-self.lZN)/self.nBins
+    self.zStep=(self.lZ0-res)-self.lZ0
+    self.implicitZ=implicit
+    if(implicit):
+      return
+    self.z=self.lZ0[:,np.newaxis]+np.arange(self.nBins)*self.zStep[:,np.newaxis]
+
+
+  ###########################################
+
+  def rangeRes(self):
     '''
-    self.z=np.empty((self.nWaves,self.nBins))
-    for i in range(0,self.nWaves):    # loop over waves
-      res=(self.lZ0[i]-self.lZN[i])/self.nBins
-      self.z[i]=np.arange(self.lZ0[i],self.lZN[i],-1.0*res)   # returns an array of floats
+    Range resolution of each wave, from
+    the span of its top and bottom bins
+    '''
+    return((self.lZ0-(self.lZ0+(self.nBins-1)*self.zStep))/self.nBins)
 
 
   ###########################################
@@ -109,7 +168,10 @@ class lvisData(object):
     '''
     Return a single waveform
     '''
-    return(self.z[ind],self.waves[ind])
+    wave=self.waves[ind] if(self.store is None) else self.store.getWave(ind)
+    if(self.implicitZ):
+      return(self.lZ0[ind]+np.arange(self.nBins)*self.zStep[ind],wave)
+    return(self.z[ind],wave)
 
 
   ###########################################
@@ -130,3 +192,266 @@ class lvisData(object):
 
 
 ###########################################
+
+class waveStore(object):
+  '''
+  Ragged store of a window of each waveform, in the
+  dtype it was read in. Bins start[i] to stop[i] of
+  wave i are held as values[offsets[i]:offsets[i+1]]
+  '''
+
+  def __init__(self,waves,start,stop):
+    '''
+    Class initialiser. Copies the windows
+    out of a full array of waves
+    '''
+    self.nWaves,self.nBins=waves.shape
+    self.start=start
+    self.offsets=np.concatenate(([0],np.cumsum(stop-start)))
+    self.values=waves[self.waveIndex(),self.binIndex()]
+
+
+  ###########################################
+
+  def waveIndex(self):
+    '''
+    Wave number of every stored value
+    '''
+    return(np.repeat(np.arange(self.nWaves),np.diff(self.offsets)))
+
+
+  ###########################################
+
+  def binIndex(self):
+    '''
+    Bin number, within its full wave,
+    of every stored value
+    '''
+    lengths=np.diff(self.offsets)
+    return(np.arange(self.offsets[-1])+np.repeat(self.start-self.offsets[:-1],lengths))
+
+
+  ###########################################
+
+  def getWave(self,ind,values=None):
+    '''
+    One full waveform, zero outside its window.
+    values can be an array laid out as the store
+    '''
+    if(values is None):
+      values=self.values
+    wave=np.zeros(self.nBins,dtype=values.dtype)
+    window=values[self.offsets[ind]:self.offsets[ind+1]]
+    wave[self.start[ind]:self.start[ind]+window.shape[0]]=window
+    return(wave)
+
+
+###########################################
+
+def readCoords(f,rows=None):
+  '''
+  Read a single coordinate per footprint from
+  an open LVIS file, the middle of the waveform
+  '''
+  nBins=f['RXWAVE'].shape[1]
+  lon0=readRows(f['LON0'],rows)       # longitude of waveform top
+  lat0=readRows(f['LAT0'],rows)       # lattitude of waveform top
+  lonN=readRows(f['LON'+str(nBins-1)],rows) # longitude of waveform bottom
+  latN=readRows(f['LAT'+str(nBins-1)],rows) # lattitude of waveform bottom
+  return((lon0+lonN)/2.0,(lat0+latN)/2.0)
+
+
+###########################################
+
+def indexRuns(rows,maxGap=0):
+  '''
+  Split sorted row numbers in to runs, returned
+  as (first,last) positions within rows. A new run
+  starts wherever rows jump by more than maxGap
+  '''
+  breaks=np.flatnonzero(np.diff(rows)>maxGap+1)+1
+  first=np.concatenate(([0],breaks))
+  last=np.concatenate((breaks,[rows.shape[0]]))
+  return(list(zip(first,last)))
+
+
+###########################################
+
+def readRows(dset,rows=None,maxGap=64,maxBytes=2**22):
+  '''
+  Read sorted rows of a h5py dataset, one
+  hyperslab per run of rows. Runs closer than
+  maxGap rows are read as a single slab while
+  it stays under maxBytes. Contiguous runs are
+  read straight in to the output array
+  '''
+  if(rows is None):
+    return(dset[()])
+
+  out=np.empty((rows.shape[0],)+dset.shape[1:],dtype=dset.dtype)
+  if(rows.shape[0]==0):
+    return(out)
+  rowBytes=out.itemsize*int(np.prod(dset.shape[1:]))
+  for first,last in slabRuns(rows,maxGap=maxGap,maxRows=max(maxBytes//rowBytes,1)):
+    start=rows[first]
+    stop=rows[last-1]+1
+    if(stop-start==last-first):
+      dset.read_direct(out,np.s_[start:stop],np.s_[first:last])
+    else:
+      out[first:last]=dset[start:stop][rows[first:last]-start]
+  return(out)
+
+
+###########################################
+
+def slabRuns(rows,maxGap=64,maxRows=65536):
+  '''
+  Join the contiguous runs of sorted rows in to
+  slabs, as (first,last) positions within rows.
+  Runs up to maxGap rows apart share a slab as
+  long as it spans no more than maxRows rows
+  '''
+  slabs=[]
+  for first,last in indexRuns(rows):
+    if(len(slabs)>0):
+      a,b=slabs[-1]
+      if((rows[first]-rows[b-1]-1<=maxGap) and (rows[last-1]-rows[a]+1<=maxRows)):
+        slabs[-1]=(a,last)
+        continue
+    slabs.append((first,last))
+  return(slabs)
+
+
+###########################################
+
+transformerCache={}
+
+def getTransformer(inEPSG,outEPSG):
+  '''
+  Transformer between two EPSG codes, made once per
+  pair and reused for the life of the process.
+  Coordinates are always in x,y (lon,lat) order
+  '''
+  key=(int(inEPSG),int(outEPSG))
+  if(key not in transformerCache):
+    from pyproj import Transformer
+    transformerCache[key]=Transformer.from_crs("epsg:"+str(key[0]),"epsg:"+str(key[1]),always_xy=True)
+  return(transformerCache[key])
+
+
+###########################################
+
+def transformCoords(x,y,inEPSG,outEPSG,chunkSize=1000000):
+  '''
+  Reproject arrays of coordinates with the cached
+  transformer, chunkSize points at a time to bound
+  the temporary memory used
+  '''
+  trans=getTransformer(inEPSG,outEPSG)
+  x=np.asarray(x,dtype=np.float64)
+  y=np.asarray(y,dtype=np.float64)
+  outX=np.empty(x.shape)
+  outY=np.empty(y.shape)
+  for start in range(0,x.shape[0],chunkSize):
+    end=start+chunkSize
+    outX[start:end],outY[start:end]=trans.transform(x[start:end],y[start:end])
+  return(outX,outY)
+
+
+###########################################
+
+def reprojectBounds(minX,minY,maxX,maxY,inEPSG,outEPSG):
+  '''
+  Reproject only the four corners of a bounding box,
+  returning the box around them. This is quick for
+  screening files, but not exact where edges curve
+  in the new projection, or for boxes over a pole
+  '''
+  x,y=transformCoords(np.array([minX,maxX,maxX,minX]),np.array([minY,minY,maxY,maxY]),inEPSG,outEPSG)
+  return(np.min(x),np.min(y),np.max(x),np.max(y))
+
+
+###########################################
+
+def boundsMask(x,y,bounds,wrap=False):
+  '''
+  Mask of points within minX,minY,maxX,maxY.
+  wrap=True tests longitude around the globe,
+  so maxX can pass 180 or 360 and points of
+  either longitude convention are caught
+  '''
+  minX,minY,maxX,maxY=bounds
+  if(wrap):
+    inX=np.mod(x-minX,360.0)<=(maxX-minX)
+  else:
+    inX=(x>=minX)&(x<maxX)
+  return(inX&(y>=minY)&(y<maxY))
+
+
+###########################################
+
+def selectBounds(lon,lat,minX,minY,maxX,maxY,bboxEPSG=None,inEPSG=4326):
+  '''
+  Indices of footprints within bounds. Bounds in
+  bboxEPSG are first turned in to a wider lon/lat
+  box, and only the footprints in that are
+  reprojected for the exact test
+  '''
+  if((bboxEPSG is None) or (int(bboxEPSG)==int(inEPSG))):
+    return(np.flatnonzero(boundsMask(lon,lat,(minX,minY,maxX,maxY))))
+  box=projectBounds(minX,minY,maxX,maxY,bboxEPSG,inEPSG)
+  useInd=np.flatnonzero(boundsMask(lon,lat,box,wrap=True))
+  x,y=transformCoords(lon[useInd],lat[useInd],inEPSG,bboxEPSG)
+  return(useInd[boundsMask(x,y,(minX,minY,maxX,maxY))])
+
+
+###########################################
+
+def projectBounds(minX,minY,maxX,maxY,bboxEPSG,inEPSG=4326,densify=50):
+  '''
+  Conservative lon/lat box, in inEPSG, around bounds
+  given in bboxEPSG, from densify points along each
+  edge, padded by the largest step between them.
+  Returns west,south,east,north for boundsMask with
+  wrap=True; east passes 180 or 360 when the box
+  crosses the antimeridian, and boxes holding a
+  pole take in every longitude up to the pole
+  '''
+  # walk round the edges
+  t=np.linspace(0.0,1.0,densify+1)[:-1]
+  x=np.concatenate((minX+(maxX-minX)*t,np.full(densify,float(maxX)),maxX-(maxX-minX)*t,np.full(densify,float(minX))))
+  y=np.concatenate((np.full(densify,float(minY)),minY+(maxY-minY)*t,np.full(densify,float(maxY)),maxY-(maxY-minY)*t))
+  lon,lat=transformCoords(x,y,bboxEPSG,inEPSG)
+  use=np.isfinite(lon)&np.isfinite(lat)
+  lon=lon[use]
+  lat=lat[use]
+
+  # largest steps between neighbouring edge points
+  latPad=np.max(np.abs(np.diff(np.append(lat,lat[0]))))
+  lonPad=np.max(np.abs(np.mod(np.diff(np.append(lon,lon[0]))+180.0,360.0)-180.0))
+  south=max(np.min(lat)-latPad,-90.0)
+  north=min(np.max(lat)+latPad,90.0)
+
+  # a pole inside the box covers every longitude
+  poleX,poleY=transformCoords(np.array([0.0,0.0]),np.array([-90.0,90.0]),inEPSG,bboxEPSG)
+  inside=boundsMask(poleX,poleY,(minX,minY,maxX,maxY))
+  if(inside[0]):
+    south=-90.0
+  if(inside[1]):
+    north=90.0
+  if(np.any(inside)):
+    return(-180.0,south,180.0,north)
+
+  # longitudes span the circle bar the largest gap between them
+  lon=np.sort(np.mod(lon,360.0))
+  gaps=np.diff(np.append(lon,lon[0]+360.0))
+  k=np.argmax(gaps)
+  if(k==lon.shape[0]-1):
+    west,east=lon[0],lon[-1]
+  else:
+    west,east=lon[k+1],lon[k]+360.0
+  west-=lonPad
+  east+=lonPad
+  if(east-west>=360.0):
+    return(-180.0,south,180.0,north)
+  return(west,south,east,north)
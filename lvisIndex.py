@@ -0,0 +1,229 @@
+'''
+A persistent spatial index of the
+footprints in a directory of LVIS files
+'''
+
+###################################
+import os
+import json
+import numpy as np
+import h5py
+from lvisClass import readCoords, indexRuns, projectBounds
+
+###################################
+
+class lvisIndex(object):
+  '''
+  Sidecar index holding the bounds of each
+  file in a campaign directory and the rows
+  of each file within tiles of a coarse grid
+  '''
+
+  def __init__(self,dataDir,filename=None,tileSize=1.0,update=True):
+    '''
+    Class initialiser. Loads the index from
+    filename (by default inside dataDir) and
+    brings it up to date with the directory.
+    tileSize is the tile width in input units
+    '''
+    self.dataDir=dataDir
+    if(filename is None):
+      filename=os.path.join(dataDir,'.lvisIndex.json')
+    self.filename=filename
+    self.tileSize=tileSize
+    self.files={}
+    self.load()
+
+    if(update):
+      self.update()
+
+
+  ###########################################
+
+  def load(self):
+    '''
+    Read the index from disk, if there
+    is one made with the same tile size
+    '''
+    if(not os.path.exists(self.filename)):
+      return
+    with open(self.filename) as f:
+      index=json.load(f)
+    if(index['tileSize']==self.tileSize):
+      self.files=index['files']
+
+
+  ###########################################
+
+  def save(self):
+    '''
+    Write the index to disk, replacing
+    the old one in a single step
+    '''
+    tmpName=self.filename+'.tmp'
+    with open(tmpName,'w') as f:
+      json.dump({'tileSize':self.tileSize,'files':self.files},f)
+    os.replace(tmpName,self.filename)
+
+
+  ###########################################
+
+  def update(self,names=None):
+    '''
+    Index new files and any whose mtime or size
+    has changed, and forget files that are gone.
+    names limits this to some files of the directory
+    '''
+    onDisk=[f for f in os.listdir(self.dataDir) if f.endswith('.h5')]
+    changed=False
+
+    # forget removed files
+    for name in list(self.files.keys()):
+      if(name not in onDisk):
+        del self.files[name]
+        changed=True
+
+    if(names is None):
+      names=onDisk
+    for name in sorted(names):
+      if(self.checkFile(name)):
+        changed=True
+
+    if(changed):
+      self.save()
+
+
+  ###########################################
+
+  def checkFile(self,name):
+    '''
+    Re-index a file if it is new or its mtime
+    or size has changed. Returns True if it was
+    '''
+    stat=os.stat(os.path.join(self.dataDir,name))
+    entry=self.files.get(name)
+    if((entry is not None) and (entry['mtime']==stat.st_mtime) and (entry['size']==stat.st_size)):
+      return(False)
+
+    self.files[name]=self.indexFile(name)
+    self.files[name]['mtime']=stat.st_mtime
+    self.files[name]['size']=stat.st_size
+    return(True)
+
+
+  ###########################################
+
+  def indexFile(self,name):
+    '''
+    Find the bounds of one file and the
+    runs of its rows within each tile
+    '''
+    f=h5py.File(os.path.join(self.dataDir,name),'r')
+    lon,lat=readCoords(f)
+    f.close()
+
+    entry={'nShots':int(lon.shape[0]),'tiles':{}}
+    if(lon.shape[0]==0):
+      entry['bounds']=None
+      return(entry)
+    entry['bounds']=[float(np.min(lon)),float(np.min(lat)),float(np.max(lon)),float(np.max(lat))]
+
+    # group rows by tile, keeping file order within each
+    ix=np.floor(lon/self.tileSize).astype(int)
+    iy=np.floor(lat/self.tileSize).astype(int)
+    order=np.lexsort((iy,ix))
+    key=np.stack((ix[order],iy[order]))
+    breaks=np.flatnonzero(np.any(np.diff(key,axis=1)!=0,axis=0))+1
+    for group in np.split(order,breaks):
+      rows=np.sort(group)
+      tile=str(ix[group[0]])+','+str(iy[group[0]])
+      entry['tiles'][tile]=[[int(rows[a]),int(rows[b-1])+1] for a,b in indexRuns(rows)]
+    return(entry)
+
+
+  ###########################################
+
+  def fileBounds(self,filename):
+    '''
+    Return the indexed bounds of a file
+    '''
+    name=os.path.basename(filename)
+    if(self.checkFile(name)):
+      self.save()
+    return(self.files[name]['bounds'])
+
+
+  ###########################################
+
+  def fileRows(self,filename,minX,minY,maxX,maxY,bboxEPSG=None,inEPSG=4326):
+    '''
+    Return the rows of a file in tiles that
+    touch the bounds. These are a superset
+    of the footprints within the bounds
+    '''
+    name=os.path.basename(filename)
+    if(self.checkFile(name)):
+      self.save()
+    return(self.boxRows(self.files[name],minX,minY,maxX,maxY,bboxEPSG,inEPSG))
+
+
+  ###########################################
+
+  def boxRows(self,entry,minX,minY,maxX,maxY,bboxEPSG=None,inEPSG=4326):
+    '''
+    Return the rows of an index entry in tiles
+    that touch bounds given in bboxEPSG, through
+    a wider box in the file's lon/lat, shifted
+    to catch either longitude convention
+    '''
+    if((bboxEPSG is None) or (int(bboxEPSG)==int(inEPSG))):
+      return(self.tileRows(entry,minX,minY,maxX,maxY))
+    x0,y0,x1,y1=projectBounds(minX,minY,maxX,maxY,bboxEPSG,inEPSG)
+    rows=[self.tileRows(entry,x0+shift,y0,x1+shift,y1) for shift in (-360.0,0.0,360.0)]
+    return(np.unique(np.concatenate(rows)))
+
+
+  ###########################################
+
+  def tileRows(self,entry,minX,minY,maxX,maxY):
+    '''
+    Return the rows of an index entry
+    in tiles that touch the bounds
+    '''
+    # leave quickly if the file misses the bounds
+    bounds=entry['bounds']
+    if((bounds is None) or (bounds[0]>=maxX) or (bounds[2]<minX) or (bounds[1]>=maxY) or (bounds[3]<minY)):
+      return(np.empty(0,dtype=int))
+
+    x0=np.floor(minX/self.tileSize)
+    x1=np.floor(maxX/self.tileSize)
+    y0=np.floor(minY/self.tileSize)
+    y1=np.floor(maxY/self.tileSize)
+    rows=[]
+    for tile,runs in entry['tiles'].items():
+      ix,iy=[int(i) for i in tile.split(',')]
+      if((ix>=x0)&(ix<=x1)&(iy>=y0)&(iy<=y1)):
+        rows.extend([np.arange(start,stop) for start,stop in runs])
+
+    if(len(rows)==0):
+      return(np.empty(0,dtype=int))
+    return(np.unique(np.concatenate(rows)))
+
+
+  ###########################################
+
+  def query(self,minX,minY,maxX,maxY,bboxEPSG=None,inEPSG=4326):
+    '''
+    Return a dictionary of the files touching
+    the bounds and their rows within them
+    '''
+    self.update()
+    found={}
+    for name in sorted(self.files.keys()):
+      rows=self.boxRows(self.files[name],minX,minY,maxX,maxY,bboxEPSG,inEPSG)
+      if(rows.shape[0]>0):
+        found[os.path.join(self.dataDir,name)]=rows
+    return(found)
+
+
+###########################################
@@ -0,0 +1,216 @@
+'''
+Optional compiled kernels for the per-waveform
+processing stages. Each works along one waveform
+at a time with a single row of scratch space. They
+are used when numba is installed, and the NumPy
+array code in processLVIS and task1 otherwise
+'''
+
+###################################
+import importlib.util
+import numpy as np
+
+# numba is slow to import, so it is only
+# looked for here and imported on first use
+haveNumba=importlib.util.find_spec("numba") is not None
+
+###################################
+
+backend='numba' if(haveNumba) else 'numpy'
+
+def setBackend(name):
+  '''
+  Choose the backend, 'numba' or 'numpy',
+  to compare their outputs or speed
+  '''
+  global backend
+  if(name not in ('numba','numpy')):
+    raise ValueError("Unknown backend "+str(name))
+  if((name=='numba') and (not haveNumba)):
+    raise ImportError("numba is not installed")
+  backend=name
+
+
+###########################################
+
+def useKernels():
+  '''
+  True if the compiled kernels are in use
+  '''
+  return(backend=='numba')
+
+
+###########################################
+
+def gaussianWeights(sigma,truncate=4.0):
+  '''
+  Weights of a Gaussian filter, made
+  as scipy's gaussian_filter1d makes them
+  '''
+  radius=int(truncate*float(sigma)+0.5)
+  x=np.arange(-radius,radius+1)
+  weights=np.exp(-0.5/(sigma*sigma)*x**2)
+  return(weights/weights.sum())
+
+
+###########################################
+
+def noiseStats(waves,noiseBins):
+  '''
+  Mean and standard deviation of the
+  first noiseBins[i] bins of each wave
+  '''
+  compileKernels()
+  return(noiseKernel(waves,noiseBins.astype(np.int64)))
+
+
+###########################################
+
+def denoise(waves,meanNoise,threshold,sigma,minWidth=3,runFilter=False,rows=None):
+  '''
+  Subtract the noise, threshold, apply the
+  width test and smooth each wave in one pass.
+  Only the waves in rows are denoised, all by
+  default, the rest being left as zeros.
+  Returns the denoised waves and the last bin
+  of each left by the width test, -1 if none.
+  Matches the batch path of lvisGround.denoise
+  '''
+  if(rows is None):
+    rows=np.arange(waves.shape[0])
+  compileKernels()
+  return(denoiseKernel(waves,rows.astype(np.int64),meanNoise.astype(np.float64),threshold.astype(np.float64),gaussianWeights(sigma),minWidth,runFilter))
+
+
+###########################################
+
+def centreOfGravity(denoised):
+  '''
+  Weighted mean bin of each wave, NaN if it
+  is empty, with its lowest peak, -1 if none
+  '''
+  compileKernels()
+  return(cofgKernel(denoised))
+
+
+###########################################
+
+noiseKernel=denoiseKernel=cofgKernel=None
+
+def compileKernels():
+  '''
+  Import numba and define the kernels,
+  the first time they are needed
+  '''
+  global noiseKernel,denoiseKernel,cofgKernel
+  if(cofgKernel is not None):
+    return
+  from numba import njit
+
+  @njit(cache=True)
+  def noiseKernel(waves,noiseBins):
+    nWaves=waves.shape[0]
+    meanNoise=np.empty(nWaves)
+    stdevNoise=np.empty(nWaves)
+    for i in range(nWaves):
+      n=noiseBins[i]
+      total=0.0
+      for j in range(n):
+        total+=waves[i,j]
+      mean=total/n
+      total=0.0
+      for j in range(n):
+        diff=waves[i,j]-mean
+        total+=diff*diff
+      meanNoise[i]=mean
+      stdevNoise[i]=np.sqrt(total/n)
+    return(meanNoise,stdevNoise)
+
+
+  @njit(cache=True)
+  def denoiseKernel(waves,rows,meanNoise,threshold,weights,minWidth,runFilter):
+    nWaves,nBins=waves.shape
+    radius=(weights.shape[0]-1)//2
+    denoised=np.zeros((nWaves,nBins))
+    lastBin=np.full(nWaves,-1)
+    row=np.empty(nBins)
+    signal=np.empty(nBins,dtype=np.bool_)
+    for i in rows:
+      # subtract noise and threshold
+      first=-1
+      last=-1
+      for j in range(nBins):
+        value=waves[i,j]-meanNoise[i]
+        if(value<threshold[i]):
+          value=0.0
+        row[j]=value
+        signal[j]=value>0.0
+        if(signal[j]):
+          if(first<0):
+            first=j
+          last=j
+
+      # minimum acceptable width
+      if(runFilter):
+        j=0
+        while(j<nBins):
+          if(signal[j]):
+            start=j
+            while((j<nBins) and signal[j]):
+              j+=1
+            if(j-start<minWidth):
+              for k in range(start,j):
+                row[k]=0.0
+          else:
+            j+=1
+      else:
+        for j in range(first+1,last):
+          if(signal[j] and not (signal[j-1] and signal[j+1])):
+            row[j]=0.0
+
+      # lowest bin left, before smoothing spreads it
+      for j in range(last,first-1,-1):
+        if((j>=0) and (row[j]!=0.0)):
+          lastBin[i]=j
+          break
+
+      # smooth, spreading each signal bin over its neighbours,
+      # as most of a thresholded wave is zero
+      for p in range(max(first,0),last+1):
+        if(row[p]!=0.0):
+          for m in range(max(p-radius,radius),min(p+radius+1,nBins-radius)):
+            denoised[i,m]+=weights[p-m+radius]*row[p]
+
+      # the ends reflect about the edge as scipy does
+      for j in range(nBins):
+        if((j>=radius) and (j<nBins-radius)):
+          continue
+        total=0.0
+        for k in range(-radius,radius+1):
+          ind=j+k
+          while((ind<0) or (ind>=nBins)):
+            ind=-ind-1 if(ind<0) else 2*nBins-1-ind
+          total+=weights[k+radius]*row[ind]
+        denoised[i,j]=total
+    return(denoised,lastBin)
+
+
+  @njit(cache=True)
+  def cofgKernel(denoised):
+    nWaves,nBins=denoised.shape
+    meanBin=np.empty(nWaves)
+    modeBin=np.full(nWaves,-1)
+    for i in range(nWaves):
+      total=0.0
+      weighted=0.0
+      for j in range(nBins):
+        value=denoised[i,j]
+        if(value>0.0):
+          total+=value
+          weighted+=j*value
+          above=denoised[i,j-1] if(j>0) else 0.0
+          below=denoised[i,j+1] if(j<nBins-1) else 0.0
+          if((value>=above) and (value>below)):
+            modeBin[i]=j
+      meanBin[i]=weighted/total if(total>0.0) else np.nan
+    return(meanBin,modeBin)
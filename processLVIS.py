@@ -5,9 +5,19 @@ Some example functions for processing LVIS data
 #######################################
 
 import numpy as np
-from lvisClass import lvisData
-from pyproj import Proj, transform
+from lvisClass import lvisData, waveStore, transformCoords, reprojectBounds
 from scipy.ndimage.filters import gaussian_filter1d
+import lvisKernels
+import stageLog
+
+
+#######################################
+
+# why a footprint has or has no ground estimate
+REASON_OK=0         # ground found
+REASON_EMPTY=1      # no return rises above the noise threshold
+REASON_CLOUD=2      # saturated return, taken to be cloud top
+REASON_NOGROUND=3   # passed screening but nothing survived denoising
 
 
 #######################################
@@ -19,20 +29,35 @@ class lvisGround(lvisData):
 
   #######################################################
 
-  def estimateGround(self,sigThresh=5,statsLen=10,minWidth=3,sWidth=0.5):
+  @stageLog.timed('estimateGround',items='nWaves')
+  def estimateGround(self,sigThresh=5,statsLen=10,minWidth=3,sWidth=0.5,runFilter=False,robust=False,compact=False,screen=True,saturation=None):
     '''
     Processes waveforms to estimate ground
     Only works for bare Earth. DO NOT USE IN TREES
+    robust=True takes noise stats from the median and MAD
+    compact=True crops the waves to their signal first
+    screen=True drops waves with no usable return
+    before denoising, see screenWaves
     '''
     # find noise statistics
-    self.findStats(statsLen=statsLen)
+    self.findStats(statsLen=statsLen,robust=robust)
 
     # set threshold
     threshold=self.setThreshold(sigThresh)
 
+    # only carry on with waves that could have a ground
+    self.active=None
+    self.reason=np.zeros(self.nWaves,dtype=np.int8)
+    if(screen):
+      self.screenWaves(threshold,saturation=saturation)
+
+    # keep only the bins around the signal
+    if(compact):
+      self.compactWaves(threshold,sWidth=sWidth)
+
 
     # remove background
-    self.denoise(threshold,minWidth=minWidth,sWidth=sWidth)
+    self.denoise(threshold,minWidth=minWidth,sWidth=sWidth,runFilter=runFilter)
 
 
   #######################################################
@@ -46,56 +71,221 @@ class lvisGround(lvisData):
 
   #######################################################
 
-  def reproject(self,inEPSG,outEPSG):
+  @stageLog.timed('reproject',items='nWaves')
+  def reproject(self,inEPSG,outEPSG,boundsOnly=False):
     '''
-    Reproject footprint coordinates
+    Reproject footprint coordinates, with a
+    transformer cached per pair of projections.
+    boundsOnly=True only reprojects the corners
+    of the bounds, for screening files quickly
     '''
-    # set projections
-    inProj=Proj(init="epsg:"+str(inEPSG))
-    outProj=Proj(init="epsg:"+str(outEPSG))
+    if(boundsOnly):
+      if(not hasattr(self,'bounds')):
+        self.bounds=self.dumpBounds()
+      self.bounds=reprojectBounds(*self.bounds,inEPSG=inEPSG,outEPSG=outEPSG)
+      return
     # reproject data
-    x,y=transform(inProj,outProj,self.lon,self.lat)
+    x,y=transformCoords(self.lon,self.lat,inEPSG,outEPSG)
     self.lon=x
     self.lat=y
 
 
   ##############################################
 
-  def findStats(self,statsLen=10):
+  def findStats(self,statsLen=10,robust=False):
     '''
     Finds standard deviation and mean of noise
+    over the first statsLen metres of each wave,
+    using that wave's own range resolution.
+    robust=True uses the median and the median
+    absolute deviation, scaled to a stdev
     '''
+    # number of bins within "statsLen" of each wave
+    noiseBins=np.clip((statsLen/self.rangeRes()).astype(int),1,self.nBins)
+    if(lvisKernels.useKernels() and (not robust)):
+      self.meanNoise,self.stdevNoise=lvisKernels.noiseStats(self.waves,noiseBins)
+      return
+    maxBins=np.max(noiseBins)
+    noise=self.waves[:,0:maxBins].astype(np.float64)
+
+    # blank bins past a shorter window
+    ragged=np.any(noiseBins<maxBins)
+    if(ragged):
+      noise[np.arange(maxBins)>=noiseBins[:,np.newaxis]]=np.nan
+
+    if(robust):
+      median=np.nanmedian if(ragged) else np.median
+      self.meanNoise=median(noise,axis=1)
+      self.stdevNoise=1.4826*median(np.abs(noise-self.meanNoise[:,np.newaxis]),axis=1)
+    elif(ragged):
+      self.meanNoise=np.nanmean(noise,axis=1)
+      self.stdevNoise=np.nanstd(noise,axis=1)
+    else:
+      self.meanNoise=np.mean(noise,axis=1)
+      self.stdevNoise=np.std(noise,axis=1)
+
+
+  ##############################################
+
+  def screenWaves(self,threshold,saturation=None):
+    '''
+    Flag waves whose peak never rises above the
+    noise threshold, and if saturation is given
+    those reaching that many counts, in reason.
+    The indices of the rest are kept in active,
+    the only waves compactWaves and denoise use
+    '''
+    peak=np.max(self.waves,axis=1)
+    level=peak-self.meanNoise
+
+    # nothing would survive the threshold
+    self.reason[(level<threshold)|(level<=0.0)]=REASON_EMPTY
 
-    # make empty arrays
-    self.meanNoise=np.empty(self.nWaves)
-    self.stdevNoise=np.empty(self.nWaves)
+    # a clipped return, from cloud tops in these flights
+    if(saturation is not None):
+      self.reason[(self.reason==REASON_OK)&(peak>=saturation)]=REASON_CLOUD
 
-    # determine number of bins to calculate stats over
-    res=(self.z[0,0]-self.z[0,-1])/self.nBins    # range resolution
-    noiseBins=int(statsLen/res)   # number of bins within "statsLen"
+    # None when all waves pass
+    active=np.flatnonzero(self.reason==REASON_OK)
+    self.active=active if(len(active)<self.nWaves) else None
 
-    # loop over waveforms
-    for i in range(0,self.nWaves):
-      self.meanNoise[i]=np.mean(self.waves[i,0:noiseBins])
-      self.stdevNoise[i]=np.std(self.waves[i,0:noiseBins])
+
+  ##############################################
+
+  def activeRows(self,*arrays):
+    '''
+    The rows of each array belonging to
+    the waves that passed screening
+    '''
+    if(getattr(self,'active',None) is None):
+      return(arrays)
+    return([a[self.active] for a in arrays])
+
+
+  def allRows(self,values,fill=0.0):
+    '''
+    Spread the rows of the waves that passed
+    screening back over all footprints
+    '''
+    if(getattr(self,'active',None) is None):
+      return(values)
+    full=np.full((self.nWaves,)+values.shape[1:],fill,dtype=values.dtype)
+    full[self.active]=values
+    return(full)
 
 
   ##############################################
 
-  def denoise(self,threshold,sWidth=0.5,minWidth=3):
+  def compactWaves(self,threshold,sWidth=0.5,blockSize=2**18):
+    '''
+    Replace waves with a waveStore of the bins of each
+    wave from the first to the last left by the threshold,
+    padded by the reach of the smoothing, so that
+    denoising the store matches denoising the full waves.
+    Waves screened out are left with empty windows.
+    The signal is found blockSize bins at a time
+    '''
+    res=self.rangeRes()[0]    # range resolution
+    pad=int(4.0*sWidth/res+0.5)
+
+    # bins left non-zero by the threshold, a block of
+    # waves at a time so the noise-free copy stays small
+    some=np.zeros(self.nWaves,dtype=bool)
+    first=np.zeros(self.nWaves,dtype=int)
+    last=np.zeros(self.nWaves,dtype=int)
+    step=max(blockSize//self.nBins,1)
+    for s in range(0,self.nWaves,step):
+      e=min(s+step,self.nWaves)
+      level=self.waves[s:e]-self.meanNoise[s:e,np.newaxis]
+      above=(level>=threshold[s:e,np.newaxis])&(level!=0.0)
+      some[s:e]=np.any(above,axis=1)
+      first[s:e]=np.argmax(above,axis=1)
+      last[s:e]=self.nBins-1-np.argmax(above[:,::-1],axis=1)
+    if(getattr(self,'active',None) is not None):
+      screened=np.ones(self.nWaves,dtype=bool)
+      screened[self.active]=False
+      some[screened]=False
+
+    start=np.where(some,np.maximum(first-pad,0),0)
+    stop=np.where(some,np.minimum(last+pad+1,self.nBins),0)
+    self.store=waveStore(self.waves,start,stop)
+    self.waves=None
+
+
+  ##############################################
+
+  def denoise(self,threshold,sWidth=0.5,minWidth=3,runFilter=False,batch=True):
     '''
     Denoise waveform data
+    batch=True denoises all waves as one array,
+    batch=False loops over them one at a time.
+    With the numba backend the batch is done by a
+    compiled kernel, one wave per pass.
+    runFilter=True drops runs of signal shorter
+    than minWidth bins, otherwise isolated bins
+    are removed. Only the waves in active are
+    denoised, the rest being left as zeros.
+    lastBin is set to the lowest bin of each wave
+    left by the width test, before smoothing,
+    or -1 if there is none
     '''
 
     # find resolution
-    res=(self.z[0,0]-self.z[0,-1])/self.nBins    # range resolution
+    res=self.rangeRes()[0]    # range resolution
+
+    if(self.store is not None):
+      # the same steps on the ragged windows of a waveStore
+      wave=self.store.waveIndex()
+      self.denoised=self.store.values-self.meanNoise[wave]
+      self.denoised[self.denoised<threshold[wave]]=0.0
+      signal=self.denoised>0.0
+      keep=widthMask(signal,self.store.offsets,minWidth=minWidth,runFilter=runFilter)
+      self.denoised[signal&~keep]=0.0
+
+      # the last signal of each window is its lowest
+      self.lastBin=np.full(self.nWaves,-1)
+      ind=np.flatnonzero(signal&keep)
+      self.lastBin[wave[ind]]=self.store.binIndex()[ind]    # later values overwrite earlier ones
+      self.denoised=smoothRagged(self.denoised,self.store.offsets,sWidth/res)
+      return
+
+    if(batch and lvisKernels.useKernels()):
+      self.denoised,self.lastBin=lvisKernels.denoise(self.waves,self.meanNoise,threshold,sWidth/res,minWidth=minWidth,runFilter=runFilter,rows=getattr(self,'active',None))
+      return
+
+    if(batch):
+      waves,meanNoise,threshold=self.activeRows(self.waves,self.meanNoise,threshold)
+
+      # subtract mean background noise
+      denoised=waves-meanNoise[:,np.newaxis]
+
+      # set all values less than threshold to zero
+      denoised[denoised<threshold[:,np.newaxis]]=0.0
+
+      # minimum acceptable width
+      signal=denoised>0.0
+      offsets=np.arange(0,signal.shape[0]+1)*self.nBins
+      keep=widthMask(signal.ravel(),offsets,minWidth=minWidth,runFilter=runFilter)
+      keep=keep.reshape(signal.shape)
+      denoised[signal&~keep]=0.0
+      signal&=keep
+
+      # bins run down from the top, so the lowest signal is the last
+      lastBin=np.where(np.any(signal,axis=1),self.nBins-1-np.argmax(signal[:,::-1],axis=1),-1)
+      self.lastBin=self.allRows(lastBin,fill=-1)
+
+      # smooth
+      self.denoised=self.allRows(gaussian_filter1d(denoised,sWidth/res,axis=1))
+      return
 
     # make array for output
-    self.denoised=np.full((self.nWaves,self.nBins),0)
+    self.denoised=np.zeros((self.nWaves,self.nBins))
+    self.lastBin=np.full(self.nWaves,-1)
+    rows=self.activeRows(np.arange(self.nWaves))[0]
 
     # loop over waves
-    for i in range(0,self.nWaves):
-      print("Denoising wave ",i,"of ",self.nWaves)
+    for n,i in enumerate(rows):
+      stageLog.progress('denoise',n+1,rows.shape[0])
 
       # subtract mean background noise
       self.denoised[i]=self.waves[i]-self.meanNoise[i]
@@ -104,14 +294,94 @@ class lvisGround(lvisData):
       self.denoised[i,self.denoised[i]<threshold[i]]=0.0
 
       # minimum acceptable width
-      binList=np.where(self.denoised[i]>0.0)[0]
-      for j in range(0,binList.shape[0]):       # loop over waveforms
-        if((j>0)&(j<(binList.shape[0]-1))):    # are we in the middle of the array?
-          if((binList[j]!=binList[j-1]+1)|(binList[j]!=binList[j+1]-1)):  # are the bins consecutive?
-            self.denoised[i,binList[j]]=0.0   # if not, set to zero
+      if(runFilter):
+        signal=self.denoised[i]>0.0
+        keep=widthMask(signal,np.array([0,self.nBins]),minWidth=minWidth,runFilter=True)
+        self.denoised[i,signal&~keep]=0.0
+      else:
+        binList=np.where(self.denoised[i]>0.0)[0]
+        for j in range(0,binList.shape[0]):       # loop over waveforms
+          if((j>0)&(j<(binList.shape[0]-1))):    # are we in the middle of the array?
+            if((binList[j]!=binList[j-1]+1)|(binList[j]!=binList[j+1]-1)):  # are the bins consecutive?
+              self.denoised[i,binList[j]]=0.0   # if not, set to zero
+
+      # lowest bin left
+      signal=np.flatnonzero(self.denoised[i]>0.0)
+      if(signal.shape[0]>0):
+        self.lastBin[i]=signal[-1]
 
       # smooth
       self.denoised[i]=gaussian_filter1d(self.denoised[i],sWidth/res)
 
 
+#######################################
+
+def smoothRagged(values,offsets,sigma,truncate=4.0):
+  '''
+  Gaussian smoothing of each segment offsets[i]:offsets[i+1]
+  of a flat array on its own, reflecting about its ends as
+  gaussian_filter1d does for a full wave. The segments are
+  reflected out by the filter radius and smoothed together
+  '''
+  radius=int(truncate*float(sigma)+0.5)
+  lengths=np.diff(offsets)
+  padded=np.where(lengths>0,lengths+2*radius,0)
+  padOffsets=np.concatenate(([0],np.cumsum(padded)))
+
+  # position of each padded value within its segment
+  seg=np.repeat(np.arange(lengths.shape[0]),padded)
+  pos=np.arange(padOffsets[-1])-padOffsets[:-1][seg]-radius
+  length=lengths[seg]
+  inside=(pos>=0)&(pos<length)
+  pos=np.mod(pos,2*length)
+  pos=np.where(pos>=length,2*length-1-pos,pos)
+
+  smooth=gaussian_filter1d(np.asarray(values,dtype=np.float64)[offsets[:-1][seg]+pos],sigma)
+  return(smooth[inside])
+
+
+#######################################
+
+def widthMask(mask,offsets,minWidth=3,runFilter=False):
+  '''
+  Find the signal bins that pass the width test.
+  mask is a flat boolean array of bins above the
+  threshold, with wave i held in offsets[i]:offsets[i+1].
+  runFilter=True keeps runs of at least minWidth bins,
+  otherwise a bin needs signal either side of it,
+  bar the first and last signal bin of each wave
+  '''
+  nVals=mask.shape[0]
+  sig=np.flatnonzero(mask)
+
+  # is there signal in the next bin up and down the same wave?
+  full=offsets[:-1]<offsets[1:]
+  left=np.zeros(nVals,dtype=bool)
+  left[1:]=mask[:-1]
+  left[offsets[:-1][full]]=False
+  right=np.zeros(nVals,dtype=bool)
+  right[:-1]=mask[1:]
+  right[offsets[1:][full]-1]=False
+
+  keep=np.zeros(nVals,dtype=bool)
+  if(runFilter):
+    # mark the start and end of every run
+    runStart=np.flatnonzero(mask&~left)
+    runEnd=np.flatnonzero(mask&~right)
+    wide=(runEnd-runStart+1)>=minWidth
+    edges=np.zeros(nVals+1,dtype=int)
+    edges[runStart[wide]]+=1
+    edges[runEnd[wide]+1]-=1
+    keep=np.cumsum(edges[:-1])>0
+  else:
+    # which wave each signal bin belongs to
+    wave=np.searchsorted(offsets,sig,side='right')-1
+    first=np.ones(sig.shape[0],dtype=bool)
+    first[1:]=wave[1:]!=wave[:-1]
+    last=np.ones(sig.shape[0],dtype=bool)
+    last[:-1]=wave[1:]!=wave[:-1]
+    keep[sig]=(left[sig]&right[sig])|first|last
+  return(keep)
+
+
 #############################################################
@@ -0,0 +1,543 @@
+'''
+Classes for reading, filling, mosaicking and
+differencing geotiffs, shared by Tasks 2 to 4.
+GDAL is only imported by the methods that use it
+'''
+
+###################################
+import numpy as np
+import stageLog
+
+###################################
+
+def summedArea(data):
+  """
+  Summed-area table of an array, padded with a
+  leading row and column of zeros so that
+  table[i,j] is the sum of data[:i,:j]
+  """
+  table = np.zeros((data.shape[0]+1,data.shape[1]+1),dtype=np.result_type(data.dtype,np.int64))
+  np.cumsum(data,axis=0,out=table[1:,1:])
+  np.cumsum(table[1:,1:],axis=1,out=table[1:,1:])
+  return table
+
+
+def focalMean(data,window,fillOnly=False):
+  """
+  NaN-ignoring mean over the (2*window+1)^2 box around
+  each pixel, from summed-area tables of the values and
+  of the count of valid pixels, so the cost does not
+  grow with the window. Pixels within window of the
+  edge are left as they are, as is data with no valid
+  pixels in its box. fillOnly=True only fills no data
+  """
+  fill = np.copy(data)
+  nY,nX = data.shape
+  if (nY <= 2*window) or (nX <= 2*window):
+    return fill
+
+  valid = np.isfinite(data)
+  if not np.any(valid):
+    return fill
+  # work relative to the mean to keep the sums small
+  ref = np.mean(data[valid],dtype=np.float64)
+  sums = summedArea(np.where(valid,data-ref,0.0))
+  counts = summedArea(valid)
+
+  # sums over every box with a centre away from the edge
+  w = 2*window+1
+  boxSum = sums[w:,w:]-sums[:-w,w:]-sums[w:,:-w]+sums[:-w,:-w]
+  boxCount = counts[w:,w:]-counts[:-w,w:]-counts[w:,:-w]+counts[:-w,:-w]
+
+  useMean = boxCount > 0
+  if fillOnly:
+    useMean &= ~valid[window:nY-window,window:nX-window]
+  inner = fill[window:nY-window,window:nX-window]
+  inner[useMean] = boxSum[useMean]/boxCount[useMean]+ref
+  return fill
+
+
+class mosaicGrid(object):
+    """
+    Campaign grid on a fixed origin and resolution that flight
+    lines are added to as they are processed, so no per-file
+    geotiffs are needed. Tiles are only made where footprints
+    land, and hold running sums and counts for the mean, or
+    the running min or max. They are kept in memory, or in a
+    HDF5 file if store is given
+    """
+    stats = {'mean':2,'min':1,'max':1}
+
+    def __init__(self,res,stat='mean',tileSize=512,store=None,epsg=3031):
+        if stat not in self.stats:
+            raise ValueError("Mosaic statistic must be one of "+", ".join(sorted(self.stats)))
+        self.res = res
+        self.stat = stat
+        self.tileSize = tileSize
+        self.epsg = epsg
+        self.nPoints = 0
+        if store is None:
+            self.store = None
+            self.tiles = {}
+        else:
+            import h5py
+            self.store = h5py.File(store,'w')
+            self.tiles = self.store
+
+    def getTile(self,key):
+        '''
+        Accumulator of one tile, made empty if new
+        '''
+        if key not in self.tiles:
+            fill = 0.0 if self.stat == 'mean' else np.nan
+            tile = np.full((self.stats[self.stat],self.tileSize*self.tileSize),fill)
+            if self.store is None:
+                self.tiles[key] = tile
+            else:
+                self.store.create_dataset(key,data=tile)
+        return self.tiles[key]
+
+    def addPoints(self,x,y,z):
+        '''
+        Add footprints in the output projection to the grid.
+        Pixel (row,col) covers x from col*res and y down from -row*res
+        '''
+        use = np.isfinite(z)
+        x,y,z = x[use],y[use],z[use]
+        if z.shape[0] == 0:
+            return
+        self.nPoints += z.shape[0]
+        cols = np.floor(x/self.res).astype(np.int64)
+        rows = np.floor(-y/self.res).astype(np.int64)
+
+        # one group of footprints per tile
+        t = self.tileSize
+        tRow,tCol = rows//t,cols//t
+        cells = (rows-tRow*t)*t+(cols-tCol*t)
+        keys,groups = np.unique(np.stack((tRow,tCol)),axis=1,return_inverse=True)
+        groups = groups.ravel()
+        order = np.argsort(groups,kind='stable')
+        breaks = np.flatnonzero(np.diff(groups[order]))+1
+        for i,group in enumerate(np.split(order,breaks)):
+            tile = self.getTile("%d_%d"%(keys[0,i],keys[1,i]))
+            acc = tile[...]
+            if self.stat == 'mean':
+                acc[0] += np.bincount(cells[group],weights=z[group],minlength=t*t)
+                acc[1] += np.bincount(cells[group],minlength=t*t)
+            elif self.stat == 'min':
+                np.fmin.at(acc[0],cells[group],z[group])
+            else:
+                np.fmax.at(acc[0],cells[group],z[group])
+            tile[...] = acc
+
+    def tileValues(self,key):
+        '''
+        Pixel values of one tile, NaN where empty
+        '''
+        acc = self.tiles[key][...]
+        if self.stat == 'mean':
+            with np.errstate(invalid='ignore',divide='ignore'):
+                values = acc[0]/acc[1]
+        else:
+            values = acc[0]
+        return values.reshape(self.tileSize,self.tileSize).astype(np.float32)
+
+    @stageLog.timed('write',items='nPoints')
+    def writeTiff(self,filename):
+        '''
+        Write the grid to a sparse tiled geotiff covering
+        the tiles that hold data, one tile at a time
+        '''
+        from osgeo import gdal, osr
+        t = self.tileSize
+        names = list(self.tiles.keys())
+        if len(names) == 0:
+            raise ValueError("No footprints in the mosaic")
+        keys = np.array([[int(i) for i in key.split('_')] for key in names],dtype=np.int64)
+        row0,col0 = keys.min(axis=0)
+        nY = int((keys[:,0].max()-row0+1)*t)
+        nX = int((keys[:,1].max()-col0+1)*t)
+
+        # set geolocation information (note geotiffs count down from top edge in Y)
+        geotransform = (float(col0*t*self.res), self.res, 0, float(-row0*t*self.res), 0, -self.res)
+
+        dst_ds = gdal.GetDriverByName('GTiff').Create(filename, nX, nY, 1, gdal.GDT_Float32, options=['TILED=YES','BLOCKXSIZE=%d'%t,'BLOCKYSIZE=%d'%t,'SPARSE_OK=TRUE','BIGTIFF=IF_SAFER'])
+        dst_ds.SetGeoTransform(geotransform)    # specify coords
+        srs = osr.SpatialReference()            # establish encoding
+        srs.ImportFromEPSG(self.epsg)           # output projection
+        dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
+        band = dst_ds.GetRasterBand(1)
+        band.SetNoDataValue(np.nan)             # set no data value
+        for key,(row,col) in zip(names,keys):
+            band.WriteArray(self.tileValues(key),int((col-col0)*t),int((row-row0)*t))
+        dst_ds.FlushCache()                     # write to disk
+        dst_ds = None
+        print("Mosaic written to",filename)
+
+    def close(self):
+        '''
+        Close the HDF5 store, if there is one
+        '''
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+
+class handleTiff(object):
+    def __init__(self,filename,readTiff=False,bufferTiff=False,openTiff=False):
+        if(readTiff):
+            self.readRaster(filename)
+        elif(openTiff):
+            self.openRaster(filename)
+
+        if(bufferTiff):
+            self.getSurround(window)
+            self.writeFilledTiff(filename)
+
+    def openRaster(self,filename):
+        '''
+        Open a geotiff and read its size and
+        geolocation, leaving the data on disk
+        '''
+        from osgeo import gdal
+        # open a dataset object
+        self.ds=gdal.Open(str(filename))
+
+        # read data from geotiff object
+        self.nX=self.ds.RasterXSize             # number of pixels in x direction
+        self.nY=self.ds.RasterYSize             # number of pixels in y direction
+        # geolocation tiepoint
+        transform_ds = self.ds.GetGeoTransform()# extract geolocation information
+        self.xOrigin=transform_ds[0]       # coordinate of x corner
+        self.yOrigin=transform_ds[3]       # coordinate of y corner
+        self.pixelWidth=transform_ds[1]    # resolution in x direction
+        self.pixelHeight=transform_ds[5]   # resolution in y direction
+
+    @stageLog.timed('readRaster',items='data',nBytes=('data',))
+    def readRaster(self,filename):
+        '''
+        Read a geotiff in to RAM
+        '''
+        print("--Reading in raster--")
+        self.openRaster(filename)
+        # read data. Returns as a 2D numpy array
+        self.data=self.readBlock(0,0,self.nX,self.nY)
+
+        return self.data
+
+    def readBlock(self,xOff,yOff,nX,nY):
+        '''
+        Read a window of an opened geotiff
+        '''
+        return self.ds.GetRasterBand(1).ReadAsArray(int(xOff),int(yOff),int(nX),int(nY))
+
+    def iterBlocks(self,blockSize=1024,halo=0):
+        '''
+        Walk an opened geotiff in square tiles of blockSize,
+        yielding (xOff,yOff,nX,nY,data,x0,y0). data holds the
+        tile plus up to halo pixels around it, with the tile
+        itself at data[y0:y0+nY,x0:x0+nX]
+        '''
+        nTiles = ((self.nY+blockSize-1)//blockSize)*((self.nX+blockSize-1)//blockSize)
+        done = 0
+        for yOff in range(0,self.nY,blockSize):
+            for xOff in range(0,self.nX,blockSize):
+                nX = min(blockSize,self.nX-xOff)
+                nY = min(blockSize,self.nY-yOff)
+                # expand by the halo, within the raster
+                xStart = max(xOff-halo,0)
+                yStart = max(yOff-halo,0)
+                xEnd = min(xOff+nX+halo,self.nX)
+                yEnd = min(yOff+nY+halo,self.nY)
+                data = self.readBlock(xStart,yStart,xEnd-xStart,yEnd-yStart)
+                yield (xOff,yOff,nX,nY,data,xOff-xStart,yOff-yStart)
+                done += 1
+                stageLog.progress('tiles',done,nTiles)
+
+    def newTiff(self,filename):
+        '''
+        Create an empty float geotiff on the
+        same grid as this one, ready to write
+        '''
+        from osgeo import gdal, osr
+        # set geolocation information (note geotiffs count down from top edge in Y)
+        geotransform = (self.xOrigin, self.pixelWidth, 0, self.yOrigin, 0, self.pixelHeight)
+
+        # load data in to geotiff object
+        dst_ds = gdal.GetDriverByName('GTiff').Create(filename, self.nX, self.nY, 1, gdal.GDT_Float32, options=['TILED=YES','BIGTIFF=IF_SAFER'])
+        dst_ds.SetGeoTransform(geotransform)    # specify coords
+        srs = osr.SpatialReference()            # establish encoding
+        srs.ImportFromEPSG(3031)                # WGS84 lat/long
+        dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
+        dst_ds.GetRasterBand(1).SetNoDataValue(np.nan)  # set no data value
+        return dst_ds
+
+    @stageLog.timed('fill',items=lambda self: self.nX*self.nY)
+    def fillTiled(self,window,filename,blockSize=1024,fillOnly=False):
+      '''
+      Tile by tile version of getSurround and writeFilledTiff
+      for an opened geotiff. Each tile is read with a halo of
+      window pixels, so the result matches the in-memory fill
+      '''
+      print("--Deploying search window of focal function in tiles--")
+      dst_ds = self.newTiff(filename)
+      band = dst_ds.GetRasterBand(1)
+      for xOff,yOff,nX,nY,data,x0,y0 in self.iterBlocks(blockSize=blockSize,halo=window):
+          fill = focalMean(data,window,fillOnly=fillOnly)
+          band.WriteArray(fill[y0:y0+nY,x0:x0+nX],xOff,yOff)
+      dst_ds.FlushCache()                     # write to disk
+      dst_ds = None
+
+      print("Image written to",filename)
+
+    @stageLog.timed('fill',items='data')
+    def getSurround(self,window,fillOnly=False,fast=True):
+      """
+      Function to differentiate between no data to fill
+      and no data to leave alone
+      Pixels at least window from the edge take the mean of
+      the valid pixels in the box around them. fillOnly=True
+      only replaces no data, fast=False uses a per-pixel loop
+      """
+      if fast:
+          print("--Deploying search window of focal function--")
+          self.fill = focalMean(self.data,window,fillOnly=fillOnly)
+          return
+
+      cols = self.data.shape[0]
+      rows = self.data.shape[1]
+
+      self.fill = np.copy(self.data)
+
+      print("--Deploying search window of focal function--")
+
+      for i in np.arange(window,cols-window): # search the data in the x dimension
+          for j in np.arange(window,rows-window): # search the data in the y dimension
+                if fillOnly and np.isfinite(self.data[i][j]):
+                    continue # leave valid data alone
+                surround_sum = np.nanmean(self.data[i-window:i+window+1,j-window:j+window+1])
+                if np.isfinite(surround_sum) == True:
+                    self.fill[i][j] = surround_sum
+                else:
+                    self.fill[i][j] = self.data[i][j] # check the sum of surrounding values
+
+    @stageLog.timed('write',items='fill')
+    def writeFilledTiff(self,filename):
+      """
+      Take the filled elevation data and create an output raster
+      """
+      dst_ds = self.newTiff(filename)
+      dst_ds.GetRasterBand(1).WriteArray(self.fill)  # write image to the raster
+      dst_ds.FlushCache()                     # write to disk
+      dst_ds = None
+
+      print("Image written to",filename)
+
+
+class clipTiff(object):
+    """
+        Class to standardize rasters for further analysis
+    """
+    def __init__(self,filename,minX,minY,maxX,maxY):
+        self.warpRaster(filename,minX,minY,maxX,maxY)
+
+    def warpRaster(self,filename,minX,minY,maxX,maxY,res=50):
+        """
+            Function using gdal.Warp to reproject a raster
+            into a particular spatial extent for the EPSG:3031 projection
+        """
+        from osgeo import gdal
+        ds = gdal.Open(str(filename))
+        self.out_filename = filename[:-4] + str("_clipped.tif") # creating output name
+        try:
+            print("--Standardizing--")
+            ds = gdal.Warp(str(self.out_filename), filename, xRes=res, yRes=-res, dstSRS='EPSG:3031', outputBounds=(minX,minY,maxX,maxY))
+            ds = None
+        except:
+            print("Sorry your bounds choices were invalid") # checking user chose valid bounds
+
+        return self.out_filename
+
+def volumeStats(difference,data1,data2,cellsize,labels=None):
+    """
+        Volume change of a difference array, and the volumes of
+        the two input arrays, in one pass with no full-size float
+        temporaries. Returns a dictionary of the total gain, loss
+        and net change, the number of valid cells and both volumes.
+        Given an integer labels array, each is an array by label
+    """
+    valid = ~np.isnan(difference)
+    valid1 = ~np.isnan(data1)
+    valid2 = ~np.isnan(data2)
+
+    if labels is None:
+        gain = np.sum(difference,where=difference>0,dtype=np.float64)*cellsize
+        loss = np.sum(difference,where=difference<0,dtype=np.float64)*cellsize
+        return {'gain':gain,'loss':loss,'net':gain+loss,
+                'n_valid':np.count_nonzero(valid),
+                'vol1':np.sum(data1,where=valid1,dtype=np.float64)*cellsize,
+                'vol2':np.sum(data2,where=valid2,dtype=np.float64)*cellsize}
+
+    # cells with no region (no data or negative labels) are left out
+    inRegion = np.isfinite(labels)&(labels>=0)
+    nLabels = int(np.max(labels,where=inRegion,initial=-1))+1
+
+    def regionSum(array,use):
+        use = use&inRegion
+        return np.bincount(labels[use].astype(int),weights=array[use],minlength=nLabels)*cellsize
+
+    gain = regionSum(difference,difference>0)
+    loss = regionSum(difference,difference<0)
+    return {'gain':gain,'loss':loss,'net':gain+loss,
+            'n_valid':np.bincount(labels[valid&inRegion].astype(int),minlength=nLabels),
+            'vol1':regionSum(data1,valid1),
+            'vol2':regionSum(data2,valid2)}
+
+
+def addStats(total,stats):
+    """
+        Add the volumeStats of one tile to a running
+        total, growing per-region arrays as needed
+    """
+    if total is None:
+        return stats
+    for key in total:
+        a = np.asarray(total[key])
+        b = np.asarray(stats[key])
+        if a.ndim > 0:
+            n = max(a.shape[0],b.shape[0])
+            a = np.pad(a,(0,n-a.shape[0]))
+            b = np.pad(b,(0,n-b.shape[0]))
+        total[key] = a+b
+    return total
+
+
+class changeDetection(object):
+    """
+        Class to detect change between two rasters
+    """
+    def __init__(self,array1,array2,tiled=False):
+        if tiled: # rasters left on disk, for blockCalc
+            self.reference = array1
+            return
+        self.arrayCalc(array1,array2) # load in array objects (from Tiffs) created in handleTiff class
+        self.volumnCalc(array1,array2)
+
+    def arrayCalc(self,array1,array2):
+        """
+            Function to calculate the difference
+            between two raster arrays
+        """
+        self.array_error = False # flag for calculus
+
+        if array1.data.shape != array2.data.shape:
+            print("You got an array problem boss") # arrays don't match each other
+            self.array_error = True # set flag
+        else:
+            self.array_difference = array2.data - array1.data # otherwise find their difference
+
+        self.reference = array2 = array1 # take each input array objects' attributes for this object
+
+    @stageLog.timed('volume',items='n_valid')
+    def volumnCalc(self,array1,array2,labels=None):
+        """
+            Function performing calculus on the arrays
+            to work out the total volumn of change
+            between them. labels is an optional handleTiff
+            of integer regions to also total volumes within
+        """
+        if self.array_error == False: # if the input arrays match in shape (can be used for calculus)
+            # get original resolution (pre-warping)
+            self.xRes = round(self.reference.pixelWidth)
+            self.yRes = -round(self.reference.pixelHeight)
+
+            # find the area of each array cell
+            self.cellsize = self.xRes*self.yRes # metres
+
+            print("--Calculating volume change--")
+            self.setVolumes(volumeStats(self.array_difference,array1.data,array2.data,self.cellsize),array1,array2)
+
+            if labels is not None:
+                self.region_stats = volumeStats(self.array_difference,array1.data,array2.data,self.cellsize,labels=labels.data)
+
+    def setVolumes(self,stats,array1,array2):
+        """
+            Keep the totals from volumeStats
+        """
+        self.total_gain = stats['gain']
+        self.total_loss = stats['loss']
+        self.total_vol_change = stats['net'] # total change (sum of all cells)
+        self.n_valid = stats['n_valid']
+        array1.total_vol = stats['vol1']
+        array2.total_vol = stats['vol2']
+
+    @stageLog.timed('volume',items='n_valid')
+    def blockCalc(self,array1,array2,filename,blockSize=1024,labels=None):
+        """
+            Tile by tile version of arrayCalc and volumnCalc
+            for rasters opened with handleTiff(openTiff=True),
+            writing the difference out one tile at a time
+        """
+        self.array_error = False # flag for calculus
+
+        if (array1.nX != array2.nX) or (array1.nY != array2.nY):
+            print("You got an array problem boss") # arrays don't match each other
+            self.array_error = True # set flag
+            return
+
+        self.reference = array1
+        # get original resolution (pre-warping)
+        self.xRes = round(self.reference.pixelWidth)
+        self.yRes = -round(self.reference.pixelHeight)
+
+        # find the area of each array cell
+        self.cellsize = self.xRes*self.yRes # metres
+
+        totals = None
+        region_totals = None
+
+        print("--Calculating change in tiles--")
+        dst_ds = self.reference.newTiff(filename)
+        band = dst_ds.GetRasterBand(1)
+        for xOff,yOff,nX,nY,data1,x0,y0 in array1.iterBlocks(blockSize=blockSize):
+            data2 = array2.readBlock(xOff,yOff,nX,nY)
+            difference = data2 - data1
+            band.WriteArray(difference,xOff,yOff)
+
+            # add up the volumes of this tile
+            totals = addStats(totals,volumeStats(difference,data1,data2,self.cellsize))
+            if labels is not None:
+                region = labels.readBlock(xOff,yOff,nX,nY)
+                region_totals = addStats(region_totals,volumeStats(difference,data1,data2,self.cellsize,labels=region))
+
+        self.setVolumes(totals,array1,array2)
+        if labels is not None:
+            self.region_stats = region_totals
+
+        dst_ds.FlushCache()                     # write to disk
+        dst_ds = None
+
+        print("Image written to",filename)
+
+    @stageLog.timed('write',items=lambda self: self.reference.nX*self.reference.nY)
+    def writeTiff(self,array_to_write,filename):
+          """
+          Take the filled elevation data and create an output raster
+          """
+          from osgeo import gdal, osr
+          # string addition to output filename
+          # set geolocation information (note geotiffs count down from top edge in Y)
+          geotransform = (self.reference.xOrigin, self.xRes, 0, self.reference.yOrigin, 0, -self.yRes)
+
+          # load data in to geotiff object
+          dst_ds = gdal.GetDriverByName('GTiff').Create(filename, self.reference.nX, self.reference.nY, 1, gdal.GDT_Float32)
+          dst_ds.SetGeoTransform(geotransform)    # specify coords
+          srs = osr.SpatialReference()            # establish encoding
+          srs.ImportFromEPSG(3031)                # WGS84 lat/long
+          dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
+          dst_ds.GetRasterBand(1).WriteArray(array_to_write)  # write image to the raster
+          dst_ds.GetRasterBand(1).SetNoDataValue(np.NaN)  # set no data value
+          dst_ds.FlushCache()                     # write to disk
+          dst_ds = None
+
+          print("Image written to",filename)
@@ -0,0 +1,199 @@
+'''
+Timing and counters of the processing stages.
+Each stage adds its wall time, the items it
+processed, the bytes it read and the peak
+memory so far to a running total, which can be
+written out as a JSON or CSV report. Nothing is
+printed unless progress is turned on
+'''
+
+###################################
+import sys
+import csv
+import json
+import time
+import resource
+import functools
+
+###################################
+
+stages={}         # running totals of each stage, in the order first run
+showProgress=False
+interval=1.0      # shortest time between progress lines (s)
+lastShown=0.0
+
+def configure(progress=False,every=1.0):
+  '''
+  Turn progress lines on or off, shown
+  at most once every every seconds
+  '''
+  global showProgress,interval
+  showProgress=progress
+  interval=every
+
+
+###########################################
+
+def peakRSS():
+  '''
+  Peak resident memory of this process so far (bytes)
+  '''
+  return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024)
+
+
+###########################################
+
+def record(name,seconds,items=0,nBytes=0,calls=1,peak=None):
+  '''
+  Add a run of a stage to its totals
+  '''
+  if(name not in stages):
+    stages[name]={'stage':name,'calls':0,'seconds':0.0,'items':0,'bytes':0,'peakRSS':0}
+  total=stages[name]
+  total['calls']+=calls
+  total['seconds']+=seconds
+  total['items']+=int(items)
+  total['bytes']+=int(nBytes)
+  total['peakRSS']=max(total['peakRSS'],peakRSS() if(peak is None) else peak)
+
+
+###########################################
+
+class stage(object):
+  '''
+  Context manager timing one run of a stage.
+  Counts can be added within it with add()
+  '''
+
+  def __init__(self,name,items=0,nBytes=0):
+    '''
+    Class initialiser
+    '''
+    self.name=name
+    self.items=items
+    self.nBytes=nBytes
+
+  def add(self,items=0,nBytes=0):
+    '''
+    Count more items and bytes read
+    '''
+    self.items+=items
+    self.nBytes+=nBytes
+
+  def __enter__(self):
+    self.start=time.perf_counter()
+    return(self)
+
+  def __exit__(self,*exc):
+    record(self.name,time.perf_counter()-self.start,self.items,self.nBytes)
+    return(False)
+
+
+###########################################
+
+def timed(name,items=None,nBytes=()):
+  '''
+  Decorator recording each call of a method as a
+  run of stage name. items is the attribute of the
+  object counted once the call is done (its size if
+  an array) or a function of the object, and nBytes
+  the array attributes whose sizes were read
+  '''
+  def decorate(method):
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+      start=time.perf_counter()
+      out=method(self,*args,**kwargs)
+      seconds=time.perf_counter()-start
+      record(name,seconds,countItems(self,items),sum([getattr(getattr(self,n,None),'nbytes',0) for n in nBytes]))
+      return(out)
+    return(wrapper)
+  return(decorate)
+
+
+def countItems(obj,items):
+  '''
+  Number of items an object holds, for timed
+  '''
+  if(items is None):
+    return(0)
+  if(callable(items)):
+    return(items(obj))
+  value=getattr(obj,items,0)
+  return(getattr(value,'size',value))
+
+
+###########################################
+
+def progress(name,done,total=None):
+  '''
+  Show how far through a loop a stage is, if
+  progress is on and the last line is at least
+  interval old. The last step is always shown
+  '''
+  global lastShown
+  if(not showProgress):
+    return
+  now=time.perf_counter()
+  finished=(total is not None) and (done>=total)
+  if((now-lastShown<interval) and (not finished)):
+    return
+  lastShown=now
+  if(total is None):
+    sys.stderr.write("\r%s: %d"%(name,done))
+  else:
+    sys.stderr.write("\r%s: %d of %d"%(name,done,total))
+  if(finished):
+    sys.stderr.write("\n")
+  sys.stderr.flush()
+
+
+###########################################
+
+def collect():
+  '''
+  Take the totals so far, clearing them, to
+  pass from a worker process back to merge()
+  '''
+  global stages
+  totals=stages
+  stages={}
+  return(totals)
+
+
+def merge(totals):
+  '''
+  Add totals from collect() to those here
+  '''
+  for name,total in totals.items():
+    record(name,total['seconds'],total['items'],total['bytes'],calls=total['calls'],peak=total['peakRSS'])
+
+
+###########################################
+
+def report():
+  '''
+  List of the totals of each stage, with
+  items per second
+  '''
+  rows=[]
+  for total in stages.values():
+    row=dict(total)
+    row['perSecond']=total['items']/total['seconds'] if(total['seconds']>0) else None
+    rows.append(row)
+  return(rows)
+
+
+def writeReport(filename):
+  '''
+  Write the stage totals to a CSV file,
+  or JSON for any other extension
+  '''
+  rows=report()
+  with open(filename,'w',newline='') as f:
+    if(filename.endswith('.csv')):
+      writer=csv.DictWriter(f,fieldnames=['stage','calls','seconds','items','perSecond','bytes','peakRSS'])
+      writer.writeheader()
+      writer.writerows(rows)
+    else:
+      json.dump({'stages':rows,'peakRSS':peakRSS()},f,indent=2)
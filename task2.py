@@ -1,16 +1,13 @@
 import numpy as np
-import rasterio
-import gdal, ogr, os, osr
-import pandas as pd
+import os
 import argparse
-from processLVIS import lvisGround
-from lvisClass import lvisData
-from task1 import flightLine
-from scipy.ndimage import label, binary_dilation
-from rasterio.merge import merge
-from rasterio.plot import show
-import glob
+from lvisIndex import lvisIndex
+from groundCache import groundCache
+import stageLog
+from flightClass import flightLine
+from rasterClass import mosaicGrid, handleTiff
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def readCommands():
   """
@@ -25,157 +22,216 @@ def readCommands():
   p.add_argument("--maxX", dest ="maxX", type=int, default=290, help=("Maximum X bound"))
   p.add_argument("--minY", dest ="minY", type=int, default=-90, help=("Minimum Y Bound"))
   p.add_argument("--maxY", dest ="maxY", type=int, default=-80, help=("Maximum Y bound"))
+  p.add_argument("--bboxEPSG", dest ="bboxEPSG", type=int, default=None, help=("Projection of the X and Y bounds, if not the input lon/lat"))
   p.add_argument("--year", dest ="LVISyear", type=int, default=2009, help=("Year of LVIS survey"))
+  p.add_argument("--window", dest ="window", type=int, default=30, help=("Search window of the gap filling focal function (pixels)"))
+  p.add_argument("--fillOnly", dest ="fillOnly", action="store_true", help=("Only fill gaps, leaving valid pixels unsmoothed"))
+  p.add_argument("--blockSize", dest ="blockSize", type=int, default=0, help=("Fill the mosaic in tiles of this many pixels (0 reads it whole)"))
+  p.add_argument("--chunk", dest ="chunkSize", type=int, default=0, help=("Footprints per processing chunk (0 reads whole files)"))
+  p.add_argument("--workers", dest ="workers", type=int, default=1, help=("Number of flight lines processed in parallel"))
+  p.add_argument("--stat", dest ="stat", type=str, default="mean", choices=["mean","median","min","max","count","std"], help=("Statistic of the footprints in each pixel: mean, median, min, max, count or std"))
+  p.add_argument("--mosaic", dest ="mosaic", type=str, default="memory", choices=["memory","disk","merge"], help=("Mosaic the flight lines on a grid in memory, on a grid stored on disk, or by merging a geotiff per file"))
+  p.add_argument("--compact", dest ="compact", action="store_true", help=("Crop each waveform to its signal before denoising, to save memory"))
+  p.add_argument("--saturation", dest ="saturation", type=float, default=None, help=("Counts at which a return is saturated, to drop waveforms clipped by cloud tops"))
+  p.add_argument("--cacheDir", dest ="cacheDir", type=str, default=None, help=("Directory caching the ground elevations of each file between runs"))
+  p.add_argument("--cacheSize", dest ="cacheSize", type=int, default=1024, help=("Size the ground cache is kept under (MB)"))
+  p.add_argument("--index", dest ="indexFile", type=str, default=None, help=("Footprint index file for the campaign directory, made if needed"))
+  p.add_argument("--progress", dest ="progress", action="store_true", help=("Show the progress of long loops"))
+  p.add_argument("--report", dest ="report", type=str, default=None, help=("Write the time, items, bytes read and peak memory of each stage to this file (.json or .csv)"))
   cmdargs = p.parse_args()
   return cmdargs
 
 
-class handleTiff(object):
-    def __init__(self,filename,readTiff=False,bufferTiff=False):
-        if(readTiff):
-            self.readRaster(filename)
-
-        if(bufferTiff):
-            self.getSurround(window)
-            self.writeFilledTiff(filename)
-
-    def readRaster(self,filename):
-        '''
-        Read a geotiff in to RAM
-        '''
-        print("--Reading in raster--")
-        # open a dataset object
-        ds=gdal.Open(str(filename))
-
-        # read data from geotiff object
-        self.nX=ds.RasterXSize             # number of pixels in x direction
-        self.nY=ds.RasterYSize             # number of pixels in y direction
-        # geolocation tiepoint
-        transform_ds = ds.GetGeoTransform()# extract geolocation information
-        self.xOrigin=transform_ds[0]       # coordinate of x corner
-        self.yOrigin=transform_ds[3]       # coordinate of y corner
-        self.pixelWidth=transform_ds[1]    # resolution in x direction
-        self.pixelHeight=transform_ds[5]   # resolution in y direction
-        # read data. Returns as a 2D numpy array
-        self.data=ds.GetRasterBand(1).ReadAsArray(0,0,self.nX,self.nY)
-
-        return self.data
-
-
-    def getSurround(self,window):
-      """
-      Function to differentiate between no data to fill
-      and no data to leave alone
-      """
-      cols = self.data.shape[0]
-      rows = self.data.shape[1]
-
-      self.fill = np.copy(self.data)
-
-      print("--Deploying search window of focal function--")
-
-      for i in np.arange(window,cols-window): # search the data in the x dimension
-          for j in np.arange(window,rows-window): # search the data in the y dimension
-                surround_sum = np.nanmean(self.data[i-window:i+window+1,j-window:j+window+1])
-                if np.isfinite(surround_sum) == True:
-                    self.fill[i][j] = surround_sum
-                else:
-                    self.fill[i][j] = self.data[i][j] # check the sum of surrounding values
-
-    def writeFilledTiff(self,filename):
-      """
-      Take the filled elevation data and create an output raster
-      """
-      # set geolocation information (note geotiffs count down from top edge in Y)
-      geotransform = (self.xOrigin, self.pixelWidth, 0, self.yOrigin, 0, self.pixelHeight)
-
-      # load data in to geotiff object
-      dst_ds = gdal.GetDriverByName('GTiff').Create(filename, self.nX, self.nY, 1, gdal.GDT_Float32)
-      dst_ds.SetGeoTransform(geotransform)    # specify coords
-      srs = osr.SpatialReference()            # establish encoding
-      srs.ImportFromEPSG(3031)                # WGS84 lat/long
-      dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
-      dst_ds.GetRasterBand(1).WriteArray(self.fill)  # write image to the raster
-      dst_ds.GetRasterBand(1).SetNoDataValue(np.nan)  # set no data value
-      dst_ds.FlushCache()                     # write to disk
-      dst_ds = None
-
-      print("Image written to",filename)
+def processFile(h5,outName,bounds,res,inEPSG=4326,outEPSG=3031,chunkSize=0,rows=None,stat='mean',bboxEPSG=None,cacheDir=None,cacheSize=1024,compact=False,saturation=None):
+  """
+  Run the read, ground, CofG, reproject and grid chain
+  on one flight line. Returns the file, the geotiff
+  written (None if no data), the seconds taken, any
+  error, so that one bad file cannot stop a batch, and
+  the stage totals from stageLog.collect() for merge().
+  With no outName the projected x, y and ground of the
+  footprints are returned in place of the geotiff.
+  rows limits reading to those rows of the file,
+  and bboxEPSG is the projection of the bounds if
+  they are not in the file's lon/lat. With a cacheDir
+  the ground of the whole file is cached there, in
+  at most cacheSize MB, and reused on later runs.
+  compact=True crops the waves to their signal, and
+  waves reaching saturation counts are dropped as cloud
+  """
+  start_time = time.time()
+  x0,y0,x1,y1 = bounds
+  try:
+    if cacheDir is not None:
+      # ground elevations from the cache, made if missing
+      cache = groundCache(cacheDir,maxBytes=cacheSize*2**20)
+      lvis = flightLine.fromCache(filename=h5,cache=cache,chunkSize=chunkSize,inEPSG=inEPSG,outEPSG=outEPSG,minX=x0,minY=y0,maxX=x1,maxY=y1,rows=rows,bboxEPSG=bboxEPSG,compact=compact,saturation=saturation)
+    elif chunkSize > 0:
+      # stream the file through in chunks, keeping only the ground estimates
+      lvis = flightLine.fromStream(filename=h5,chunkSize=chunkSize,inEPSG=inEPSG,outEPSG=outEPSG,minX=x0,minY=y0,maxX=x1,maxY=y1,rows=rows,bboxEPSG=bboxEPSG,compact=compact,saturation=saturation)
+    else:
+      # take these bounds with processing
+      lvis = flightLine(filename=h5,minX=x0,minY=y0,maxX=x1,maxY=y1,rows=rows,bboxEPSG=bboxEPSG,inEPSG=inEPSG)
+      # checkpoint == 0 means it contains no data
+      if lvis.checkpoint == 1:
+        # denoise the data and find the ground
+        lvis.setElevations(implicit=True)
+        lvis.estimateGround(compact=compact,saturation=saturation)
+        lvis.CofG()
+        lvis.reproject(inEPSG=inEPSG,outEPSG=outEPSG)
+
+    if lvis.checkpoint == 0:
+      return(h5,None,time.time()-start_time,None,stageLog.collect())
+
+    if outName is None:
+      # hand the ground back for a campaign mosaic
+      use = np.isfinite(lvis.zG)
+      return(h5,(lvis.lon[use],lvis.lat[use],lvis.zG[use]),time.time()-start_time,None,stageLog.collect())
+
+    # write out the ground elevations to a tiff
+    lvis.writeSingleTiff(filename=outName,res=res,stat=stat)
+  except Exception as e:
+    return(h5,None,time.time()-start_time,repr(e),stageLog.collect())
+
+  return(h5,outName,time.time()-start_time,None,stageLog.collect())
+
+
+def batchProcess(h5s,outDir,bounds,res,workers=1,rows=None,**kwargs):
+  """
+  Process flight lines across a pool of worker
+  processes, yielding the result of each file
+  from processFile as soon as it finishes.
+  rows is an optional dictionary of the rows
+  to read from each file. With no outDir the
+  footprints are returned rather than written
+  """
+  if rows is None:
+    rows = {}
+  if outDir is None:
+    jobs = [(h5,None) for h5 in h5s]
+  else:
+    jobs = [(h5,os.path.join(outDir,os.path.basename(h5)[:-3]+'.tif')) for h5 in h5s]
+
+  if workers <= 1:
+    for h5,outName in jobs:
+      yield processFile(h5,outName,bounds,res,rows=rows.get(h5),**kwargs)
+    return
+
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = {}
+    for h5,outName in jobs:
+      futures[pool.submit(processFile,h5,outName,bounds,res,rows=rows.get(h5),**kwargs)] = h5
+    for future in as_completed(futures):
+      try:
+        yield future.result()
+      except Exception as e:   # the worker itself died
+        yield (futures[future],None,np.nan,repr(e),{})
+
 
 if __name__=="__main__":
     start_time = time.time()
     cmd = readCommands()
+    stageLog.configure(progress=cmd.progress)
     # set the directory
 
-    dataDir = b'/geos/netdata/avtrain/data/3d/oosa/assignment/lvis/'+str(cmd.LVISyear)+'/'
-    x0 = cmd.minX
-    x1 = cmd.maxX
-    y0 = cmd.minY
-    y1 = cmd.maxY
+    dataDir = '/geos/netdata/avtrain/data/3d/oosa/assignment/lvis/'+str(cmd.LVISyear)+'/'
+    bounds = (cmd.minX,cmd.minY,cmd.maxX,cmd.maxY)
 
     h5s = []
-    for file in os.listdir(dataDir):
-        file = str(file)
-        if file.endswith(".h5"): # take the files we want
-            h5s.append(os.path.join(dataDir,file)) # make a list of them
-
-    # loop through these files
-    for h5 in h5s:
-        print("Processing file ", h5)
-        # take these bounds with processing
-        lvis = flightLine(filename=h5,minX=x0,minY=y0,maxX=x1,maxY=y1)
-        # take checkpoint which is set upon reading the file
-        # checkpoint == 0 means it contains no data
-        # checkpoint == 1 means it contains data and thus to continue...
-        if lvis.checkpoint == 1:
-            # denoise the data and find the ground
-            lvis.setElevations()
-            lvis.estimateGround()
-            lvis.CofG()
-            lvis.reproject(inEPSG=4326,outEPSG=3031)
-
-            # write out filled data to a tiff
-            lvis.writeSingleTiff(filename=h5,res=cmd.outRes)
-
-            # then start all over again!
-
-    # directory holding the tifs processd above
+    rows = None
+    if cmd.indexFile is not None:
+        # only the files, and rows of them, the index says touch the bounds
+        index = lvisIndex(dataDir,filename=cmd.indexFile)
+        rows = index.query(*bounds,bboxEPSG=cmd.bboxEPSG,inEPSG=cmd.inEPSG)
+        h5s = sorted(rows.keys())
+    else:
+        for file in os.listdir(dataDir):
+            file = str(file)
+            if file.endswith(".h5"): # take the files we want
+                h5s.append(os.path.join(dataDir,file)) # make a list of them
+
+    # directory holding the tifs processed below
     tifDir = r'./'+str(cmd.LVISyear)+'/'
+    os.makedirs(tifDir,exist_ok=True)
     # output name
     out_tif = r'./'+str(cmd.LVISyear)+'/'+str(cmd.LVISyear)+'_LVIS_merged_200m.tif'
 
-    # criteria to find the geotiffs
-    search_criteria = '*.tif'
-    tifs = os.path.join(tifDir, search_criteria)
-
-    # taking all the files that match and globbing together
-    dem_fps = glob.glob(tifs)
-
-    # opening each of these file names and putting them into a list for the merge
-    tifs_4_mosaic = []
-    for fp in dem_fps:
-        src = rasterio.open(fp)
-        tifs_4_mosaic.append(src)
-
-    # merging them
-    dest, out_trans = merge(tifs_4_mosaic) # merge returns single array
-
-    #updating the metadata
-    out_meta = src.meta.copy()
-    out_meta.update({"driver": "Gtiff",
-                        "height": dest.shape[1],
-                        "width": dest.shape[2],
-                        "transform": out_trans})
-
-    # writing out the merged file
-    with rasterio.open(out_tif, "w", **out_meta) as dest1:
-        dest1.write(dest)
-
-    # writing back in this merged file with smaller bounds
-    dem = handleTiff(filename=out_tif,readTiff=True)
-    dem.getSurround(window=30)
-
-    # write out filled dem
-    dem.writeFilledTiff(filename='./'+str(cmd.LVISyear)+'/'+str(cmd.LVISyear)+"_LVIS_dem_filled_200m.tif")
-
+    if cmd.mosaic == "merge":
+        import rasterio
+        from rasterio.merge import merge
+        # process the files, opening each geotiff for the merge as it is finished
+        tifs_4_mosaic = []
+        failed = []
+        for h5,tif,seconds,error,stages in batchProcess(h5s,tifDir,bounds,cmd.outRes,workers=cmd.workers,rows=rows,inEPSG=cmd.inEPSG,outEPSG=cmd.outEPSG,chunkSize=cmd.chunkSize,stat=cmd.stat,bboxEPSG=cmd.bboxEPSG,cacheDir=cmd.cacheDir,cacheSize=cmd.cacheSize,compact=cmd.compact,saturation=cmd.saturation):
+            stageLog.merge(stages)
+            if error is not None:
+                print("Failed on file",h5,"after %.1f seconds:"%seconds,error)
+                failed.append(h5)
+            elif tif is None:
+                print("No data in file",h5,"(%.1f seconds)"%seconds)
+            else:
+                print("Processed file",h5,"in %.1f seconds"%seconds)
+                src = rasterio.open(tif)
+                tifs_4_mosaic.append(src)
+
+        print(len(tifs_4_mosaic),"of",len(h5s),"files gridded,",len(failed),"failed")
+        if len(tifs_4_mosaic) == 0:
+            raise SystemExit("No data to mosaic")
+
+        # merging them
+        dest, out_trans = merge(tifs_4_mosaic) # merge returns single array
+
+        #updating the metadata
+        out_meta = src.meta.copy()
+        out_meta.update({"driver": "Gtiff",
+                            "height": dest.shape[1],
+                            "width": dest.shape[2],
+                            "transform": out_trans})
+
+        # writing out the merged file
+        with rasterio.open(out_tif, "w", **out_meta) as dest1:
+            dest1.write(dest)
+    else:
+        # add each file to one campaign grid as soon as it is finished
+        if cmd.stat not in mosaicGrid.stats:
+            raise SystemExit("--stat "+cmd.stat+" needs --mosaic merge")
+        store = out_tif[:-4]+'_grid.h5' if cmd.mosaic == "disk" else None
+        mosaic = mosaicGrid(cmd.outRes,stat=cmd.stat,store=store,epsg=cmd.outEPSG)
+        nGridded = 0
+        failed = []
+        for h5,points,seconds,error,stages in batchProcess(h5s,None,bounds,cmd.outRes,workers=cmd.workers,rows=rows,inEPSG=cmd.inEPSG,outEPSG=cmd.outEPSG,chunkSize=cmd.chunkSize,bboxEPSG=cmd.bboxEPSG,cacheDir=cmd.cacheDir,cacheSize=cmd.cacheSize,compact=cmd.compact,saturation=cmd.saturation):
+            stageLog.merge(stages)
+            if error is not None:
+                print("Failed on file",h5,"after %.1f seconds:"%seconds,error)
+                failed.append(h5)
+            elif points is None:
+                print("No data in file",h5,"(%.1f seconds)"%seconds)
+            else:
+                print("Processed file",h5,"in %.1f seconds"%seconds)
+                mosaic.addPoints(*points)
+                nGridded += 1
+
+        print(nGridded,"of",len(h5s),"files gridded,",len(failed),"failed")
+        if mosaic.nPoints == 0:
+            raise SystemExit("No data to mosaic")
+        mosaic.writeTiff(out_tif)
+        mosaic.close()
+        if store is not None:
+            os.remove(store)
+
+    filled_tif = './'+str(cmd.LVISyear)+'/'+str(cmd.LVISyear)+"_LVIS_dem_filled_200m.tif"
+    if cmd.blockSize > 0:
+        # fill the merged file tile by tile, without reading it whole
+        dem = handleTiff(filename=out_tif,openTiff=True)
+        dem.fillTiled(window=cmd.window,filename=filled_tif,blockSize=cmd.blockSize,fillOnly=cmd.fillOnly)
+    else:
+        # writing back in this merged file with smaller bounds
+        dem = handleTiff(filename=out_tif,readTiff=True)
+        dem.getSurround(window=cmd.window,fillOnly=cmd.fillOnly)
+
+        # write out filled dem
+        dem.writeFilledTiff(filename=filled_tif)
+
+    if cmd.report is not None:
+        stageLog.writeReport(cmd.report)
     print("--- %s seconds ---" % (time.time() - start_time))
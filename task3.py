@@ -1,9 +1,7 @@
-from osgeo import gdal
 import argparse
-from task2 import handleTiff
+from rasterClass import handleTiff, clipTiff, changeDetection
+import stageLog
 import numpy as np
-import ogr, os, osr
-import matplotlib.pyplot as plt
 import time
 
 """
@@ -23,133 +21,69 @@ def readCommands():
   p.add_argument("--maxX", dest ="maxX", type=int, default=-1002275, help=("Maximum X bound"))
   p.add_argument("--minY", dest ="minY", type=int, default=-501171, help=("Minimum Y Bound"))
   p.add_argument("--maxY", dest ="maxY", type=int, default=-53369, help=("Maximum Y bound"))
+  p.add_argument("--blockSize", dest ="blockSize", type=int, default=0, help=("Process the rasters in tiles of this many pixels (0 reads them whole)"))
+  p.add_argument("--regions", dest ="regions", type=str, default=None, help=("Raster of integer region labels (eg drainage basins) to total volumes within"))
+  p.add_argument("--progress", dest ="progress", action="store_true", help=("Show the progress of long loops"))
+  p.add_argument("--report", dest ="report", type=str, default=None, help=("Write the time, items, bytes read and peak memory of each stage to this file (.json or .csv)"))
   cmdargs = p.parse_args()
   return cmdargs
 
-class clipTiff(object):
-    """
-        Class to standardize rasters for further analysis
-    """
-    def __init__(self,filename,minX,minY,maxX,maxY):
-        self.warpRaster(filename,minX,minY,maxX,maxY)
-
-    def warpRaster(self,filename,minX,minY,maxX,maxY,res=50):
-        """
-            Function using gdal.Warp to reproject a raster
-            into a particular spatial extent for the EPSG:3031 projection
-        """
-        ds = gdal.Open(str(filename))
-        self.out_filename = filename[:-4] + str("_clipped.tif") # creating output name
-        try:
-            print("--Standardizing--")
-            ds = gdal.Warp(str(self.out_filename), filename, xRes=res, yRes=-res, dstSRS='EPSG:3031', outputBounds=(minX,minY,maxX,maxY))
-            ds = None
-        except:
-            print("Sorry your bounds choices were invalid") # checking user chose valid bounds
-
-        return self.out_filename
-
-class changeDetection(object):
-    """
-        Class to detect change between two rasters
-    """
-    def __init__(self,array1,array2):
-        self.arrayCalc(array1,array2) # load in array objects (from Tiffs) created in handleTiff class
-        self.volumnCalc(array1,array2)
-
-    def arrayCalc(self,array1,array2):
-        """
-            Function to calculate the difference
-            between two raster arrays
-        """
-        self.array_error = False # flag for calculus
-
-        if array1.data.shape != array2.data.shape:
-            print("You got an array problem boss") # arrays don't match each other
-            self.array_error = True # set flag
-        else:
-            self.array_difference = array2.data - array1.data # otherwise find their difference
-
-        self.reference = array2 = array1 # take each input array objects' attributes for this object
-
-    def volumnCalc(self,array1,array2):
-        """
-            Function performing calculus on the arrays
-            to work out the total volumn of change
-            between them
-        """
-        if self.array_error == False: # if the input arrays match in shape (can be used for calculus)
-            # get original resolution (pre-warping)
-            self.xRes = round(self.reference.pixelWidth)
-            self.yRes = -round(self.reference.pixelHeight)
-
-            # find the area of each array cell
-            self.cellsize = self.xRes*self.yRes # metres
-
-            # set up new array
-            self.vol_change_per_cell = np.copy(self.array_difference)
-
-            print("--Calculating volume change--")
-            # loop through extent
-            for i in np.arange(0,self.reference.nY-1):
-                for j in np.arange(0,self.reference.nX)-1:
-                    if np.isnan(self.array_difference[i][j]) == False:
-                        # calculate volumn change per cell
-                        self.vol_change_per_cell[i][j] = self.array_difference[i][j] * self.cellsize
-
-            # total change (sum of all cells)
-            self.total_vol_change = np.nansum(self.vol_change_per_cell.flat)
-
-            # calculate total volumn per cell in each year
-            array2.vol_per_cell = array2.data *  self.cellsize
-            array2.total_vol = np.nansum(array2.vol_per_cell.flat)
-
-            array1.vol_per_cell = array1.data *  self.cellsize
-            array1.total_vol = np.nansum(array1.vol_per_cell.flat)
-
-    def writeTiff(self,array_to_write,filename):
-          """
-          Take the filled elevation data and create an output raster
-          """
-          # string addition to output filename
-          # set geolocation information (note geotiffs count down from top edge in Y)
-          geotransform = (self.reference.xOrigin, self.xRes, 0, self.reference.yOrigin, 0, -self.yRes)
-
-          # load data in to geotiff object
-          dst_ds = gdal.GetDriverByName('GTiff').Create(filename, self.reference.nX, self.reference.nY, 1, gdal.GDT_Float32)
-          dst_ds.SetGeoTransform(geotransform)    # specify coords
-          srs = osr.SpatialReference()            # establish encoding
-          srs.ImportFromEPSG(3031)                # WGS84 lat/long
-          dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
-          dst_ds.GetRasterBand(1).WriteArray(array_to_write)  # write image to the raster
-          dst_ds.GetRasterBand(1).SetNoDataValue(np.NaN)  # set no data value
-          dst_ds.FlushCache()                     # write to disk
-          dst_ds = None
-
-          print("Image written to",filename)
-
-
 if __name__=="__main__":
     start_time = time.time()
     cmd = readCommands()
+    stageLog.configure(progress=cmd.progress)
 
     # Two files being prepared for computation (standardisation prior to processing)
     clip_file_1 = clipTiff(filename=r'./2009/2009_LVIS_dem_filled_200m.tif',minX=cmd.minX,minY=cmd.minY,maxX=cmd.maxX,maxY=cmd.maxY)
     clip_file_2 = clipTiff(filename=r'./2015/2015_LVIS_dem_filled_200m.tif',minX=cmd.minX,minY=cmd.minY,maxX=cmd.maxX,maxY=cmd.maxY)
 
-    # Reading out the clipped raster arrays
-    array_1 = handleTiff(filename=str(clip_file_1.out_filename),readTiff=True)
-    array_2 = handleTiff(filename=str(clip_file_2.out_filename),readTiff=True)
-
-    # Reading these back in for calculations
-    output = changeDetection(array_1,array_2)
-    output.volumnCalc(array_1,array_2)
-
-    # Write out the raster of change detection
-    output.writeTiff(array_to_write=output.array_difference,filename=r'./results/elevation_change_output.tif')
+    # Optional raster of regions, put on the same grid
+    clip_regions = None
+    if cmd.regions is not None:
+        clip_regions = clipTiff(filename=cmd.regions,minX=cmd.minX,minY=cmd.minY,maxX=cmd.maxX,maxY=cmd.maxY)
 
+    out_tif = r'./results/elevation_change_output.tif'
+    tiled = cmd.blockSize > 0
+    if not tiled:
+        try:
+            # Reading out the clipped raster arrays
+            array_1 = handleTiff(filename=str(clip_file_1.out_filename),readTiff=True)
+            array_2 = handleTiff(filename=str(clip_file_2.out_filename),readTiff=True)
+
+            # Reading these back in for calculations
+            output = changeDetection(array_1,array_2)
+            if clip_regions is not None:
+                regions = handleTiff(filename=str(clip_regions.out_filename),readTiff=True)
+                output.volumnCalc(array_1,array_2,labels=regions)
+
+            # Write out the raster of change detection
+            output.writeTiff(array_to_write=output.array_difference,filename=out_tif)
+        except MemoryError:
+            print("Rasters too big to hold in memory, processing in tiles instead")
+            array_1 = array_2 = output = None
+            tiled = True
+
+    if tiled:
+        # Leave the clipped rasters on disk and work through them a tile at a time
+        array_1 = handleTiff(filename=str(clip_file_1.out_filename),openTiff=True)
+        array_2 = handleTiff(filename=str(clip_file_2.out_filename),openTiff=True)
+        regions = None
+        if clip_regions is not None:
+            regions = handleTiff(filename=str(clip_regions.out_filename),openTiff=True)
+        output = changeDetection(array_1,array_2,tiled=True)
+        output.blockCalc(array_1,array_2,filename=out_tif,blockSize=cmd.blockSize if cmd.blockSize > 0 else 1024,labels=regions)
+
+    if output.array_error == False:
+        print("Volume gained: %.1f m3, lost: %.1f m3, net change: %.1f m3 over %d cells" % (output.total_gain,output.total_loss,output.total_vol_change,output.n_valid))
+        if clip_regions is not None:
+            for label in np.flatnonzero(output.region_stats['n_valid']):
+                print("Region %d net change: %.1f m3 over %d cells" % (label,output.region_stats['net'][label],output.region_stats['n_valid'][label]))
+
+    if cmd.report is not None:
+        stageLog.writeReport(cmd.report)
     print("--- %s seconds ---" % (time.time() - start_time))
 
+    import matplotlib.pyplot as plt
     plt.plot()
     plt.ylabel("Change in Elevation (m)")
     plt.xlabel("Relative Latitude (Top to Bottom)")
@@ -1,16 +1,13 @@
 from __future__ import division
 # Importing local classes
-from task3 import changeDetection
-from task3 import clipTiff
-from task2 import handleTiff
+from rasterClass import changeDetection, clipTiff, handleTiff
+import stageLog
 
 # Importing external packages
 import numpy as np
-import matplotlib.pyplot as plt
 import argparse
-from scipy.ndimage import label
-from shapely.geometry import Point
-import pandas as pd
+import os
+import struct
 import time
 
 
@@ -25,23 +22,153 @@ def readCommands():
   p.add_argument("--minY", dest ="minY", type=int, default=-281171, help=("Minimum Y Bound"))
   p.add_argument("--maxY", dest ="maxY", type=int, default=-20369, help=("Maximum Y bound"))
   p.add_argument("--output", dest ="outfile", type=str, default="raster_contours.tif", help=("Output filename"))
+  p.add_argument("--lines", dest ="linefile", type=str, default="./results/contours.gpkg", help=("Output contour lines (.gpkg or .shp)"))
+  p.add_argument("--progress", dest ="progress", action="store_true", help=("Show the progress of long loops"))
+  p.add_argument("--report", dest ="report", type=str, default=None, help=("Write the time, items, bytes read and peak memory of each stage to this file (.json or .csv)"))
   cmdargs = p.parse_args()
   return cmdargs
 
 
+def focal3x3(array,combine,fill):
+    """
+        Combine each pixel with its 3x3 neighbourhood using
+        a ufunc such as np.add or np.maximum, treating
+        pixels beyond the edge of the array as fill
+    """
+    nY,nX = array.shape
+    padded = np.full((nY+2,nX+2),fill,dtype=array.dtype)
+    padded[1:-1,1:-1] = array
+
+    out = np.copy(array)
+    for dy in range(3):
+        for dx in range(3):
+            if (dy != 1) or (dx != 1):
+                combine(out,padded[dy:dy+nY,dx:dx+nX],out=out)
+    return out
+
+
+# marching squares: the cell edges (0 top, 1 right, 2 bottom, 3 left) each
+# case joins, where the case has bits 8,4,2,1 set for corners at or above
+# the level in the order top left, top right, bottom right, bottom left
+SQUARE_EDGES = {1:(3,2), 2:(2,1), 3:(3,1), 4:(0,1), 6:(0,2), 7:(3,0), 8:(3,0),
+                9:(0,2), 11:(0,1), 12:(3,1), 13:(2,1), 14:(3,2)}
+# saddles, split by whether the cell centre is at or above the level
+SADDLE_EDGES = {(5,True):((3,0),(2,1)), (5,False):((0,1),(3,2)),
+                (10,True):((0,1),(3,2)), (10,False):((3,0),(2,1))}
+
+
+def edgeCrossing(grid,i,j,edge,level):
+    """
+        Where a contour crosses one edge of the cells with
+        top left pixel (i,j). Returns a key unique to that
+        edge of the grid and the (row,col) of the crossing
+    """
+    nX = grid.shape[1]
+    if edge == 0:   # top
+        i0,j0,i1,j1 = i,j,i,j+1
+    elif edge == 1: # right
+        i0,j0,i1,j1 = i,j+1,i+1,j+1
+    elif edge == 2: # bottom
+        i0,j0,i1,j1 = i+1,j,i+1,j+1
+    else:           # left
+        i0,j0,i1,j1 = i,j,i+1,j
+    v0 = grid[i0,j0]
+    t = (level-v0)/(grid[i1,j1]-v0)
+    key = 2*(i0*nX+j0)+(i1-i0)  # horizontal edges even, vertical odd
+    return key,i0+t*(i1-i0),j0+t*(j1-j0)
+
+
+def traceContours(grid,level):
+    """
+        Trace the contour lines of a grid at one level with
+        marching squares, interpolating where each line
+        crosses between pixel centres. Returns a list of
+        (rows,cols) arrays, one per line, in pixel units.
+        Cells with a no data corner are skipped
+    """
+    tl = grid[:-1,:-1]
+    tr = grid[:-1,1:]
+    br = grid[1:,1:]
+    bl = grid[1:,:-1]
+    with np.errstate(invalid='ignore'):
+        case = 8*(tl>=level)+4*(tr>=level)+2*(br>=level)+(bl>=level)
+        centre = (tl+tr+br+bl)/4 >= level
+    case[np.isnan(tl)|np.isnan(tr)|np.isnan(br)|np.isnan(bl)] = 0
+
+    # the two ends of every segment
+    ends = [[],[]]
+    for c,pair in SQUARE_EDGES.items():
+        ends[0].append((case==c,pair[0]))
+        ends[1].append((case==c,pair[1]))
+    for (c,above),pairs in SADDLE_EDGES.items():
+        for pair in pairs:
+            ends[0].append(((case==c)&(centre==above),pair[0]))
+            ends[1].append(((case==c)&(centre==above),pair[1]))
+
+    keys = []
+    rows = []
+    cols = []
+    for side in ends:
+        for cells,edge in side:
+            i,j = np.nonzero(cells)
+            key,r,c = edgeCrossing(grid,i,j,edge,level)
+            keys.append(key)
+            rows.append(r)
+            cols.append(c)
+    keys = np.concatenate(keys)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    nSeg = keys.shape[0]//2
+    if nSeg == 0:
+        return []
+
+    # end slot s and s+nSeg belong to the same segment. Slots
+    # sharing an edge key are joined, and there are at most two
+    partner = np.full(2*nSeg,-1)
+    order = np.argsort(keys,kind='stable')
+    joined = np.flatnonzero(keys[order[1:]] == keys[order[:-1]])
+    partner[order[joined]] = order[joined+1]
+    partner[order[joined+1]] = order[joined]
+
+    # walk the segments in to lines, open ones first then loops
+    partner = partner.tolist()
+    visited = [False]*nSeg
+    lines = []
+    starts = [s for s in range(2*nSeg) if partner[s] < 0]+list(range(nSeg))
+    for s in starts:
+        if visited[s%nSeg]:
+            continue
+        slots = [s]
+        while True:
+            visited[s%nSeg] = True
+            other = (s+nSeg)%(2*nSeg)
+            slots.append(other)
+            s = partner[other]
+            if (s < 0) or visited[s%nSeg]:
+                break
+        lines.append((rows[slots],cols[slots]))
+    return lines
+
+
+def lineWkb(x,y):
+    """
+        Well-known binary of a LineString
+    """
+    points = np.empty((x.shape[0],2),dtype='<f8')
+    points[:,0] = x
+    points[:,1] = y
+    return struct.pack('<BII',1,2,x.shape[0])+points.tobytes()
+
+
 class ContourRast(changeDetection):
+    @stageLog.timed('contour',items='rounded')
     def roundCont(self,interval):
         """
             Reclassing the array's values to
             the contour interval set by the user
         """
-        self.rounded = np.copy(self.array_difference) # copy array to round
-
-        for i in np.arange(0,self.reference.nY):
-            for j in np.arange(0,self.reference.nX):
-                if np.isnan(self.array_difference[i][j]) == False:
-                    self.rounded[i][j] = interval*round(self.array_difference[i][j]/interval) # find its nearest-whole-multiple of the interval
-                    print("Rounding raster value", self.array_difference[i][j], "to contour interval ", self.rounded[i][j])
+        # find each value's nearest-whole-multiple of the interval
+        self.rounded = interval*np.round(self.array_difference/interval)
 
         self.findEdge()
 
@@ -50,24 +177,30 @@ class ContourRast(changeDetection):
             Finding values at the edge of interval change (i.e a contour)
             and taking the maximum value of that change
         """
-        self.edge = np.copy(self.rounded)
-
         print("--Finding the edge pixels--")
 
-        for i in np.arange(1,self.reference.nY): # search the data in the x dimension
-            for j in np.arange(1,self.reference.nX): # search the data in the y dimension
-                if np.isnan(self.rounded[i][j]) == False:
-                    surround_mean = np.nanmean(self.rounded[i-1:i+2,j-1:j+2])
-                    # if the mean of all pixels isn't the same as the centre pixel (must be an edge)
-                    # if its the maximum of the edge then use it (contour interval upwards)
-                    if self.rounded[i][j] != surround_mean:
-                         self.edge[i][j] = self.rounded[i][j] # then its a contour
-                    else: # otherwise discard it as no data
-                        self.edge[i][j] = np.nan
-                    self.edge[0][j] = np.nan
-                    self.edge[i][-1] = np.nan
-                    self.edge[i][0] = np.nan
-                    self.edge[-1][j] = np.nan
+        valid = ~np.isnan(self.rounded)
+
+        # mean of the valid pixels around each pixel
+        surround_sum = focal3x3(np.where(valid,self.rounded,0),np.add,0)
+        surround_count = focal3x3(valid.astype(int),np.add,0)
+        with np.errstate(invalid='ignore'):
+            surround_mean = surround_sum/surround_count
+
+        # if the mean of all pixels isn't the same as the centre pixel (must be an edge)
+        self.edge = np.copy(self.rounded)
+        inner = np.copy(valid)
+        inner[0,:] = False
+        inner[:,0] = False
+        self.edge[inner & (self.rounded == surround_mean)] = np.nan # otherwise discard it as no data
+
+        # clear the border wherever its row or column holds data
+        cols = np.any(valid[1:,1:],axis=0)
+        rows = np.any(valid[1:,1:],axis=1)
+        self.edge[0,1:][cols] = np.nan
+        self.edge[-1,1:][cols] = np.nan
+        self.edge[1:,0][rows] = np.nan
+        self.edge[1:,-1][rows] = np.nan
 
         self.findCont()
 
@@ -76,17 +209,17 @@ class ContourRast(changeDetection):
             Function to find the raster array value locations ideal
             for Contouring
         """
+        valid = ~np.isnan(self.edge)
 
-        self.cont = np.copy(self.edge)
+        # find the maximum surrounding value
+        surround_max = focal3x3(np.where(valid,self.edge,-np.inf),np.maximum,-np.inf)
 
-        for i in np.arange(1,self.reference.nY): # search the data in the x dimension
-            for j in np.arange(1,self.reference.nX): # search the data in the y dimension
-                if np.isnan(self.edge[i][j]) == False:
-                    surround_max = np.nanmax(self.edge[i-1:i+2,j-1:j+2]) # find the maximum surrounding value
-                    if self.edge[i][j] == surround_max: # if the value == maximum then it must be the upper contour
-                        self.cont[i][j] = self.edge[i][j] # so keep it
-                    else:
-                        self.cont[i][j] = np.nan # otherwise clear the data point
+        # if the value == maximum then it must be the upper contour, so keep it
+        self.cont = np.copy(self.edge)
+        inner = np.copy(valid)
+        inner[0,:] = False
+        inner[:,0] = False
+        self.cont[inner & (self.edge != surround_max)] = np.nan # otherwise clear the data point
 
         self.findPosition()
 
@@ -95,15 +228,13 @@ class ContourRast(changeDetection):
             Extracting the latitude and longitude
             of the contour points
         """
-        self.cont_lon = np.copy(self.cont)
-        self.cont_lat = np.copy(self.cont)
+        is_cont = ~np.isnan(self.cont)
+        i = np.arange(0,self.reference.nY)[:,np.newaxis]
+        j = np.arange(0,self.reference.nX)[np.newaxis,:]
 
-        for i in np.arange(0,self.reference.nY): # search the data in the x dimension
-            for j in np.arange(0,self.reference.nX): # search the data in the y dimension
-                if np.isnan(self.cont_lon[i][j]) == False: # if it is a contour
-                    self.cont_lon[i][j] = self.reference.xOrigin + (self.xRes*i) # find its longitude
-                if np.isnan(self.cont_lat[i][j]) == False: # if it is a contour
-                    self.cont_lat[i][j] = self.reference.yOrigin + (self.yRes*j) # find its latitude
+        # as before, longitude steps with the row index and latitude with the column
+        self.cont_lon = np.where(is_cont,self.reference.xOrigin + (self.xRes*i),np.nan).astype(self.cont.dtype)
+        self.cont_lat = np.where(is_cont,self.reference.yOrigin + (self.yRes*j),np.nan).astype(self.cont.dtype)
 
         self.groupConts()
 
@@ -112,68 +243,129 @@ class ContourRast(changeDetection):
         """
             Grouping each line of unique contour
             values according to points adjacent (including
-            the diagonal)
+            the diagonal), for every contour value in one pass
         """
-
-        # Only works well if number of unique values isn't very high (ie contour interval is high), otherwise its slow
-        values = np.unique(self.cont.ravel()) # extract all unique values to consider for grouping
-        offset = 0
-        self.result = np.zeros_like(self.cont) # set an empty array
-        s = [[1,1,1], # structure feature to consider features diagonally as well
-            [1,1,1],
-            [1,1,1]]
-
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
         print("--Classifying unique contour lines--")
 
-        for v in values: # find each unique value and its adjacent values
-            labelled, num_features = label(self.cont == v, structure=s)
-            # label each unique combination of touching unique values
-            self.result += labelled + offset*(labelled > 0)
-            offset += num_features
+        nY,nX = self.cont.shape
+        valid = ~np.isnan(self.cont)
+        nPoints = np.count_nonzero(valid)
+
+        # number the contour points in raster order
+        index = np.full((nY,nX),-1,dtype=np.int64)
+        index[valid] = np.arange(nPoints)
+
+        # link each point to alike neighbours right and below (including the diagonal)
+        src = []
+        dst = []
+        for dy,dx in ((0,1),(1,-1),(1,0),(1,1)):
+            ya = slice(0,nY-dy)
+            yb = slice(dy,nY)
+            xa = slice(max(0,-dx),nX-max(0,dx))
+            xb = slice(max(0,dx),nX-max(0,-dx))
+            alike = self.cont[ya,xa] == self.cont[yb,xb]
+            src.append(index[ya,xa][alike])
+            dst.append(index[yb,xb][alike])
+        src = np.concatenate(src)
+        dst = np.concatenate(dst)
+        links = coo_matrix((np.ones(src.shape[0],dtype=np.int8),(src,dst)),shape=(nPoints,nPoints))
+        num_features,group = connected_components(links,directed=False)
+
+        # number the lines by value, then by where they first appear
+        first = np.unique(group,return_index=True)[1]
+        levels = self.cont[valid][first]
+        ids = np.empty(num_features,dtype=np.int64)
+        ids[np.lexsort((first,levels))] = np.arange(1,num_features+1)
+
+        self.result = np.zeros((nY,nX),dtype=np.int64)
+        self.result[valid] = ids[group]
 
         self.groupFeatures()
 
     def groupFeatures(self):
         """
-            Creating dictionary to store each contour
-            line's ID, co-orindates and value
+            Collecting each contour line's ID, co-ordinates and
+            value in to columns. The points of line id[k] are
+            x[offsets[k]:offsets[k+1]] and y likewise
         """
+        ids = self.result.ravel()
+        points = np.flatnonzero(ids)
+        # sort the points by line, keeping raster order within each
+        points = points[np.argsort(ids[points],kind='stable')]
+
         # Find how many unique contours were made
-        self.feature_ids = np.unique(self.result.ravel())
-
-        self.list_of_features = []
-        lon_list = []
-        lat_list = []
-        for k in np.arange(1,self.feature_ids.max()+1):
-            for i in np.arange(1,self.reference.nY): # search the data in the x dimension
-                for j in np.arange(1,self.reference.nX): # search the data in the y dimension
-                    if self.result[i][j] == k:
-                        print("Extracting contour ID ",k)
-                        # Separate grouped results according to their id (k)(and thus elevation value)
-                        lon_list.append(float(self.cont_lon[i][j]))
-                        lat_list.append(float(self.cont_lat[i][j]))
-                        value = self.cont[i][j]
-
-            # dictionary Grouping points of each contour line and the line's value
-            self.list_of_features.append({'id': k, 'lon': lon_list, 'lat': lat_list, 'elev': value})
-            lon_list = []
-            lat_list = []
-
-    def writeMultistring(self):
+        num_features = int(ids.max()) if ids.shape[0] > 0 else 0
+        self.feature_ids = np.arange(1,num_features+1)
+        counts = np.bincount(ids[points],minlength=num_features+1)[1:]
+        offsets = np.concatenate(([0],np.cumsum(counts)))
+
+        self.features = {'id': self.feature_ids,
+                         'offsets': offsets,
+                         'x': self.cont_lon.ravel()[points],
+                         'y': self.cont_lat.ravel()[points],
+                         'level': self.cont.ravel()[points[offsets[:-1]]]}
+
+    @stageLog.timed('contour',items='n_lines')
+    def writeMultistring(self,filename,interval,tileSize=512,batchSize=10000):
         """
-            Writing the coordinates out to a Shapefile
+            Writing the contours of array_difference out as lines
+            (GeoPackage, or Shapefile for a .shp filename). Lines
+            are traced a tile at a time with marching squares and
+            written straight to the layer in transactions of
+            batchSize, so only one tile's lines are held at once.
+            Lines crossing tile edges are split there
         """
-        try: # extract data values to a pandas datafrom
-            df = pd.DataFrame([self.list_of_features.items()], columns=['elev','id','lat','lon'])
-            geometry =[Point(xy) for xy in zip(df.lon,df.lat)]
-
-            # assign its geometry
-            geo_df = gp.GeoDataFrame(df,crs='epsg:3031',geometry=geometry)
-
-            # write out as a shapefile
-            geo_df.to_file(driver='ESRI Shapefile', filename='data.shp')
-        except:
-            print("Ah well you tried")
+        from osgeo import ogr, osr
+        driver = 'ESRI Shapefile' if filename.endswith('.shp') else 'GPKG'
+        drv = ogr.GetDriverByName(driver)
+        if os.path.exists(filename):
+            drv.DeleteDataSource(filename)
+        ds = drv.CreateDataSource(filename)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(3031)
+        layer = ds.CreateLayer('contours',srs,ogr.wkbLineString)
+        layer.CreateField(ogr.FieldDefn('id',ogr.OFTInteger))
+        layer.CreateField(ogr.FieldDefn('elev',ogr.OFTReal))
+        defn = layer.GetLayerDefn()
+
+        print("--Tracing contour lines--")
+        grid = self.array_difference
+        nY,nX = grid.shape
+        n_lines = 0
+        layer.StartTransaction()
+        nTiles = len(range(0,nY-1,tileSize))*len(range(0,nX-1,tileSize))
+        done = 0
+        for r0 in range(0,nY-1,tileSize):
+            for c0 in range(0,nX-1,tileSize):
+                done += 1
+                stageLog.progress('contour tiles',done,nTiles)
+                # tiles overlap by a pixel, so no cell is missed
+                tile = grid[r0:r0+tileSize+1,c0:c0+tileSize+1]
+                if np.all(np.isnan(tile)):
+                    continue
+                low = np.ceil(np.nanmin(tile)/interval)
+                high = np.floor(np.nanmax(tile)/interval)
+                for level in interval*np.arange(low,high+1):
+                    for rows,cols in traceContours(tile,level):
+                        # pixel centres to map co-ordinates
+                        x = self.reference.xOrigin+(c0+cols+0.5)*self.reference.pixelWidth
+                        y = self.reference.yOrigin+(r0+rows+0.5)*self.reference.pixelHeight
+                        feature = ogr.Feature(defn)
+                        feature.SetField('id',n_lines)
+                        feature.SetField('elev',float(level))
+                        feature.SetGeometry(ogr.CreateGeometryFromWkb(lineWkb(x,y)))
+                        layer.CreateFeature(feature)
+                        n_lines += 1
+                        if n_lines%batchSize == 0:
+                            layer.CommitTransaction()
+                            layer.StartTransaction()
+        layer.CommitTransaction()
+        ds = None
+        self.n_lines = n_lines
+
+        print(n_lines,"contour lines written to",filename)
 
 
 if __name__=="__main__":
@@ -185,6 +377,7 @@ if __name__=="__main__":
     start_time = time.time()
 
     cmd = readCommands()
+    stageLog.configure(progress=cmd.progress)
 
     # Load the two filled DEMs (2009 and 2015) for clipping
     clip_file_1 = clipTiff(filename=r'./2009/2009_LVIS_dem_filled_200m.tif',minX=cmd.minX,minY=cmd.minY,maxX=cmd.maxX,maxY=cmd.maxY)
@@ -197,13 +390,16 @@ if __name__=="__main__":
     out = ContourRast(array_1,array_2) # Loading in these arrays that we want
     out.roundCont(interval=cmd.interval) # finding the contours (of elevation difference) at a set interval
 
-    out.writeMultistring() # writing out a shapefile of the contours
+    out.writeMultistring(filename=cmd.linefile,interval=cmd.interval) # writing out the contour lines
     out.writeTiff(array_to_write=out.cont,filename=cmd.outfile)
     out.writeTiff(array_to_write=out.rounded,filename=r'./results/contours_classed.tif') # writing out a raster of the contours
 
+    if cmd.report is not None:
+        stageLog.writeReport(cmd.report)
     print("--- %s seconds ---" % (time.time() - start_time))
 
     # plotting contour point locations
+    import matplotlib.pyplot as plt
     plt.plot(-out.cont_lat,out.cont_lon)
     plt.xlabel("Longitude")
     plt.ylabel("Latitude")